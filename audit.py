@@ -0,0 +1,63 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from definitions import *
+import phyml
+
+
+BASE_MODEL_FREE_PARAMS = {"JC": 0, "F81": 3, "K80": 1, "HKY": 4, "SYM": 5, "GTR": 8}
+
+
+def get_expected_cost(full_model):
+	"""
+	:return: a sort key of the expected phyml running time of the model: rate heterogeneity (+I+G, then +G, then +I)
+	dominates the running time, then the number of substitution model parameters
+	"""
+	heterogeneity_cost = 2 * ("+G" in full_model) + ("+I" in full_model)
+	return heterogeneity_cost, BASE_MODEL_FREE_PARAMS[re.sub(r'\+.*', '', full_model)]
+
+
+def count_free_parameters(full_model, ntaxa):
+	"""
+	:return: the number of free parameters of the model, including the 2n-3 branch lengths of an unrooted tree
+	"""
+	return BASE_MODEL_FREE_PARAMS[re.sub(r'\+.*', '', full_model)] + ("+I" in full_model) + ("+G" in full_model) + \
+	       2 * ntaxa - 3
+
+
+def run_all_models(msa_filepath, fixed_tree=None, cpus=None):
+	"""
+	runs phyml with all the candidate models concurrently, the longest expected runs first to minimize the total time
+	:param fixed_tree: (optional) a topology that is shared by all runs, otherwise a ml tree is reconstructed per model
+	:param cpus: the number of concurrent phyml runs, default: the number of cpus
+	:return: a dictionary of every model to its phyml stats filepath
+	"""
+	models = sorted(ALL_PHYML_MODELS, key=get_expected_cost, reverse=True)
+	with ThreadPoolExecutor(max_workers=cpus or os.cpu_count()) as executor:
+		futures = {model: executor.submit(phyml.run_phyml, msa_filepath, model,
+		                                  topology="fixed" if fixed_tree else "ml", tree_file=fixed_tree)
+		           for model in models}
+		return {model: futures[model].result()[0] for model in ALL_PHYML_MODELS}
+
+
+def audit_models(msa_filepath, ntaxa, nchars, models_ranks, fixed_tree=None, cpus=None):
+	"""
+	:param models_ranks: a dictionary of every model to its ModelTeller rank
+	:return: a dataframe with the ModelTeller rank and the phyml logL, AIC, BIC and total branch lengths of every
+	model, by ModelTeller ranking
+	"""
+	stats_filepaths = run_all_models(msa_filepath, fixed_tree, cpus)
+	rows = []
+	for model in ALL_PHYML_MODELS:
+		stats_dict = phyml.parse_phyml_stats_file(stats_filepaths[model])
+		log_likelihood = float(stats_dict["logL"])
+		n_params = count_free_parameters(model, ntaxa)
+		rows.append({"model": model, "modelteller_rank": models_ranks[model], "logL": log_likelihood,
+		             "n_params": n_params, "AIC": 2 * n_params - 2 * log_likelihood,
+		             "BIC": n_params * math.log(nchars) - 2 * log_likelihood,
+		             "tree_size": float(stats_dict["tree_size"])})
+
+	audit_df = pd.DataFrame(rows)
+	audit_df["AIC_rank"] = audit_df["AIC"].rank(method="min")
+	audit_df["BIC_rank"] = audit_df["BIC"].rank(method="min")
+	audit_df.sort_values("modelteller_rank", inplace=True, kind="mergesort")
+	return audit_df
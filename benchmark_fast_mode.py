@@ -0,0 +1,95 @@
+import random
+
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+from definitions import *
+from utils import *
+import compute_features
+import distance_tree
+import modelteller
+
+
+def simulate_alignment(ntaxa, nchars, rng):
+	"""
+	simulates an alignment along a random tree, under GTR+I+G with random parameters
+	:param rng: numpy random Generator, of the tree as well
+	:return: a biopython alignment object
+	"""
+	random.seed(int(rng.integers(2**32)))  # ete3 populate draws from the random module
+	tree = Tree()
+	tree.populate(ntaxa, names_library=["Sp%03d" % i for i in range(ntaxa)], random_branches=True,
+	              branch_range=(0.005, 0.3))
+	rel_rates = np.append(rng.lognormal(0, 0.8, 5), 1)
+	freqs = rng.dirichlet([10] * 4)
+	alpha, pinv = rng.lognormal(0, 1), rng.uniform(0, 0.5)
+	rate_matrix, _ = distance_tree.get_rate_matrix(rel_rates, freqs)
+
+	# rate 0 for invariable sites, otherwise one of the gamma categories
+	rates = np.append(0, distance_tree.compute_gamma_rates(alpha) / (1 - pinv))
+	site_rates = np.where(rng.random(nchars) < pinv, 0,
+	                      rng.integers(1, distance_tree.GAMMA_CATEGORIES + 1, nchars))
+	states = {tree: rng.choice(4, nchars, p=freqs)}
+	for node in tree.iter_descendants(strategy="preorder"):
+		transition_matrices = distance_tree.get_transition_matrices(rate_matrix, freqs, node.dist * rates)
+		cumulative_probs = np.cumsum(transition_matrices[site_rates, states[node.up]], axis=1)
+		states[node] = np.minimum((rng.random(nchars)[:, None] > cumulative_probs).sum(axis=1), 3)
+
+	return AlignIO.MultipleSeqAlignment([SeqRecord(Seq("".join(np.array(list("ACGT"))[states[leaf]])), id=leaf.name)
+	                                     for leaf in tree.iter_leaves()])
+
+
+def predict_best_model(msa, msa_filepath, fast):
+	"""
+	:return: the model ranked first by ModelTeller (without a fixed topology), and the features computation time
+	"""
+	start_time = time.time()
+	ext_df, _ = compute_features.prepare_features_df(msa, msa_filepath, False, None, fast=fast)
+	features_time = time.time() - start_time
+	modelteller.predict_sklearn(ext_df, MODELTELLER_RF_MODEL)
+	return ext_df.loc[ext_df["pred_Bs"].idxmin(), "model"], features_time
+
+
+def run_benchmark(corpus_dir, n_alignments, seed):
+	"""
+	compares the model selected with the fast mode to the model selected with the full pipeline on a synthetic corpus
+	:return: a dataframe with a row per alignment
+	"""
+	rng = np.random.default_rng(seed)
+	os.makedirs(corpus_dir, exist_ok=True)
+	rows = []
+	for i in range(n_alignments):
+		ntaxa, nchars = int(rng.integers(8, 60)), int(rng.integers(200, 2000))
+		msa_filepath = os.path.join(corpus_dir, "sim_%03d.phy" % i)
+		msa = simulate_alignment(ntaxa, nchars, rng)
+		AlignIO.write(msa, msa_filepath, "phylip-relaxed")
+
+		full_model, full_time = predict_best_model(msa, msa_filepath, fast=False)
+		fast_model, fast_time = predict_best_model(msa, msa_filepath, fast=True)
+		rows.append({"msa": msa_filepath, "ntaxa": ntaxa, "nchars": nchars, "full_model": full_model,
+		             "fast_model": fast_model, "full_time": full_time, "fast_time": fast_time})
+		logger.info("%s: full %s (%.1f sec), fast %s (%.1f sec)" % (msa_filepath, full_model, full_time, fast_model,
+		                                                           fast_time))
+	results_df = pd.DataFrame(rows)
+	results_df["rank1_agreement"] = results_df["full_model"] == results_df["fast_model"]
+	return results_df
+
+
+if __name__ == '__main__':
+	logger = logging.getLogger('ModelTeller fast mode benchmark')
+	init_commandline_logger(logger)
+
+	parser = argparse.ArgumentParser(description='Rank-1 agreement of the fast mode with the full ModelTeller pipeline')
+	parser.add_argument('--corpus_dir', '-c', default="fast_mode_benchmark",
+						help='A directory for the simulated alignments and the results table.')
+	parser.add_argument('--n_alignments', '-n', type=int, default=50,
+						help='The number of simulated alignments.')
+	parser.add_argument('--seed', type=int, default=1, help='Random seed of the simulations.')
+	args = parser.parse_args()
+
+	results_df = run_benchmark(args.corpus_dir, args.n_alignments, args.seed)
+	results_df.to_csv(os.path.join(args.corpus_dir, "fast_mode_benchmark.csv"), index=False)
+	logger.info("Rank-1 agreement with the full pipeline: %d/%d (%.1f%%)" %
+	            (results_df["rank1_agreement"].sum(), len(results_df), 100 * results_df["rank1_agreement"].mean()))
+	logger.info("Mean features time: full %.2f sec, fast %.2f sec" %
+	            (results_df["full_time"].mean(), results_df["fast_time"].mean()))
@@ -0,0 +1,60 @@
+from definitions import *
+import compute_features
+import msa_functions
+import tree_functions
+
+
+BOOTSTRAP_SEED = 1
+
+
+def draw_site_weights(pattern_counts, n_replicates, seed=BOOTSTRAP_SEED):
+	"""
+	non-parametric bootstrap of the alignment sites, drawn as multinomial weights of the site patterns
+	:param pattern_counts: the number of sites of every pattern in the msa
+	:return: array of shape (n_replicates, npatterns) with the number of sites of every pattern in every replicate
+	"""
+	rng = np.random.default_rng(seed)
+	nchars = pattern_counts.sum()
+	return rng.multinomial(nchars, pattern_counts / nchars, size=n_replicates)
+
+
+def compute_replicates_features(msa, sample, features_tree, n_replicates, duplicates=None, rows=None,
+                                seed=BOOTSTRAP_SEED):
+	"""
+	recomputes the msa features for bootstrap replicates of the msa sites. the GTR+I+G tree features are not
+	recomputed, they are taken from the features of the original msa
+	:param msa: bio.AlignIO format, of the distinct sequences if duplicates were collapsed
+	:param sample: the features of the msa (see compute_features.extract_features)
+	:param features_tree: the tree from which the features were computed, without the duplicates
+	:param duplicates, rows: (optional) see msa_functions.collapse_duplicate_sequences
+	:return: a dataframe with the features of a replicate per row
+	"""
+	patterns, pattern_counts = msa_functions.get_site_patterns(msa)
+	site_weights = draw_site_weights(pattern_counts, n_replicates, seed)
+	replicates_features = compute_features.calculate_patterns_alignment_features(patterns, site_weights,
+	                                                                             rows=rows if duplicates else None)
+
+	if duplicates:
+		features_tree = tree_functions.reinsert_duplicate_tips(features_tree, duplicates)
+	ingroup_names, reduced_rows = compute_features.get_reduced_msa_sequences(
+		tree_functions.reroot_at_largest_branch(features_tree), duplicates)
+	all_names = [rec.id for rec in msa]
+	reduced_patterns, reduced_site_weights = msa_functions.reduce_patterns_to_rows(
+		patterns, site_weights, [all_names.index(name) for name in ingroup_names])
+	replicates_features.update(compute_features.calculate_patterns_alignment_features(
+		reduced_patterns, reduced_site_weights, reduced=True, rows=reduced_rows))
+
+	replicates_df = pd.DataFrame({k: [sample[k]] * n_replicates for k in sample})
+	for k in replicates_features:
+		replicates_df[k] = replicates_features[k]
+	return replicates_df
+
+
+def get_rank1_frequencies(ext_df):
+	"""
+	:param ext_df: predictions of the replicates, with a row per replicate ("index") and model, and "pred_Bs"
+	:return: a series of the fraction of replicates in which every model was ranked first
+	"""
+	preds_df = ext_df.pivot(index='index', columns='model', values='pred_Bs')[ALL_PHYML_MODELS]
+	first_models = preds_df.idxmin(axis=1)  # in case there multiple minimals, take the first, as for the msa
+	return first_models.value_counts(normalize=True).reindex(ALL_PHYML_MODELS, fill_value=0)
@@ -1,6 +1,6 @@
 from definitions import *
 
-import msa_functions, tree_functions, phyml
+import msa_functions, tree_functions, phyml, distance_tree
 from utils import *
 
 
@@ -23,19 +23,22 @@ def break_model_column(df, column_name):
 
 
 def compute_tree_features(phyml_stats_filepath, phyml_tree_filepath, feat_prefix):
+	"""
+	:param phyml_stats_filepath: phyml stats file, or a dictionary of its parsed values
+	:param phyml_tree_filepath: the corresponding tree file
+	"""
 	tree = tree_functions.get_newick_tree(phyml_tree_filepath)
 	bl_estimates = tree_functions.get_branch_lengths_estimates(tree)
 	tree_diam_estimates = tree_functions.get_diameters_estimates(tree)
 	cnt_diam_estimates = tree_functions.get_diameters_estimates(phyml_tree_filepath, actual_bl=False)
 	frac_cherries = tree_functions.get_frac_of_cherries(tree)
-	largest_branch_node = tree_functions.get_largest_branch(tree)
-	try:
-		tree.set_outgroup(largest_branch_node)
-	except ete3.coretype.tree.TreeError:
-		pass
+	tree = tree_functions.reroot_at_largest_branch(tree)
 
 	stem85, stem90 = tree_functions.get_stemminess_indexes(tree)
-	stats_dict = phyml.parse_phyml_stats_file(phyml_stats_filepath)
+	if isinstance(phyml_stats_filepath, dict):
+		stats_dict = dict(phyml_stats_filepath)
+	else:
+		stats_dict = phyml.parse_phyml_stats_file(phyml_stats_filepath)
 
 	model_phyml_features_dict = {}
 	model_phyml_features_dict["max_bl"], model_phyml_features_dict["min_bl"], \
@@ -63,9 +66,15 @@ def compute_tree_features(phyml_stats_filepath, phyml_tree_filepath, feat_prefix
 	return tree, new_dict
 
 
-def calculate_alignment_features(msa, reduced=False):
-	pinv_100 = msa_functions.count_fully_conserved_fraction(msa)
-	entropy = msa_functions.get_msa_avg_entropy(msa)
+def calculate_alignment_features(msa, reduced=False, rows=None):
+	"""
+	:param rows: (optional) for msas of collapsed duplicates, the row in msa of every sequence of the full msa (see
+	msa_functions.collapse_duplicate_sequences). the features are computed as for the full msa; the site-patterns
+	features do not depend on the number of copies of a sequence
+	"""
+	weights = None if rows is None else msa_functions.get_multiplicities(rows, len(msa))
+	pinv_100 = msa_functions.count_fully_conserved_fraction(msa, rows)
+	entropy = msa_functions.get_msa_avg_entropy(msa, rows)
 	bb_multinomial, n_unique_sites, frac_unique_sites = msa_functions.calculate_bollback_multinomial(msa)
 
 	sample = {}
@@ -75,9 +84,9 @@ def calculate_alignment_features(msa, reduced=False):
 		bb_multinomial, n_unique_sites, frac_unique_sites
 
 	if not reduced:
-		freqs = msa_functions.compute_base_frequencies(msa)
+		freqs = msa_functions.compute_base_frequencies(msa, weights)
 		substitution_statistics_dict, pairiwse_substitution_values_dict \
-			= msa_functions.calculate_substitution_rates(msa)
+			= msa_functions.calculate_substitution_rates(msa, weights)
 
 		sample.update(substitution_statistics_dict)
 		sample.update(pairiwse_substitution_values_dict)
@@ -91,15 +100,81 @@ def calculate_alignment_features(msa, reduced=False):
 	return sample
 
 
-def extract_features(msa, msa_file, GTRIG_topology, user_tree_file):
+def calculate_patterns_alignment_features(patterns, site_weights, reduced=False, rows=None):
+	"""
+	calculate_alignment_features computed from the site patterns of the msa, for several weightings of the patterns
+	at once (see msa_functions.get_site_patterns)
+	:param site_weights: array of shape (nreplicates, npatterns), the number of sites of every pattern in every replicate
+	:param rows: (optional) as in calculate_alignment_features, the row in patterns of every sequence of the full msa
+	:return: a dictionary of the features to arrays of a value per replicate
+	"""
+	codes = msa_functions.NUCLEOTIDE_CODES[patterns]
+	msa_lengths = site_weights.sum(axis=1)
+	full_patterns = patterns if rows is None else patterns[rows]
+
+	sample = {}
+	sample["pinv_sites_100p"] = site_weights @ msa_functions.get_patterns_fully_conserved(full_patterns) / msa_lengths
+	sample["aln_entropy"] = site_weights @ msa_functions.calculate_patterns_entropy(full_patterns) / msa_lengths
+	row_weights = np.ones(len(patterns)) if rows is None else msa_functions.get_multiplicities(rows, len(patterns))
+	sample["bollback_multinomial"], sample["n_unique_sites"], sample["frac_unique_sites"] = \
+		msa_functions.calculate_patterns_bollback_multinomial(site_weights)
+
+	if not reduced:
+		substitution_statistics_dict, pairiwse_substitution_values_dict \
+			= msa_functions.calculate_patterns_substitution_rates(codes, site_weights, row_weights)
+		sample.update(substitution_statistics_dict)
+		sample.update(pairiwse_substitution_values_dict)
+		sample.update(msa_functions.compute_patterns_base_frequencies(codes, site_weights, row_weights))
+	else:
+		sample = {"rmsa_" + k: sample[k] for k in sample}
+
+	return sample
+
 
+def get_reduced_msa_sequences(a_tree, duplicates=None):
+	"""
+	:param a_tree: the features tree, rerooted at its largest branch (see compute_tree_features)
+	:param duplicates: (optional) see msa_functions.collapse_duplicate_sequences, a_tree includes the duplicates
+	:return: the names of the sequences without "outgroup" (the smaller side of the largest branch). if duplicates
+	were collapsed, only the kept copy of every sequence is named, and the row of every leaf of the ingroup in the
+	names is returned as well (see msa_functions.collapse_duplicate_sequences), None otherwise
+	"""
+	outgroup_leaves, ingroup_leaves = \
+		tree_functions.get_internal_and_external_leaves_relative_to_subroot \
+			(a_tree, tree_functions.get_largest_branch(a_tree))
+	if len(outgroup_leaves) > len(ingroup_leaves):
+		ingroup_leaves, outgroup_leaves = outgroup_leaves, ingroup_leaves
+	ingroup_names = [leaf.name for leaf in ingroup_leaves]
+	reduced_rows = None
+	if duplicates:
+		# the leaves are of the full msa, map every leaf to the kept copy of its sequence, by the order of the leaves
+		representative_of = {name: rep_name for rep_name in duplicates for name in [rep_name] + duplicates[rep_name]}
+		leaves_representatives = [representative_of[name] for name in ingroup_names]
+		ingroup_names = list(dict.fromkeys(leaves_representatives))
+		reduced_rows = np.array([ingroup_names.index(name) for name in leaves_representatives], dtype=np.int64)
+	return ingroup_names, reduced_rows
+
+
+def extract_features(msa, msa_file, GTRIG_topology, user_tree_file, duplicates=None, fast=False, rows=None):
+	"""
+	:param duplicates: (optional) if msa has collapsed duplicates (see msa_functions.collapse_duplicate_sequences),
+	the names of the removed copies of every sequence. features are computed as for the full msa
+	:param rows: the row in msa of every sequence of the full msa, required with duplicates
+	:param fast: True - approximate the GTR+I+G rates run with an in-process BioNJ tree instead of running phyml.
+	not available with a fixed topology
+	"""
 	# extract from MSA
 	ntaxa, nchars = msa_functions.get_msa_properties(msa)
-	msa_features_dict = calculate_alignment_features(msa)
+	if duplicates:
+		ntaxa = len(rows)
+	msa_features_dict = calculate_alignment_features(msa, rows=rows if duplicates else None)
 
 	# run phyml for rates and extract assessments
 	opt_rates_model = "GTR+I+G"
-	if GTRIG_topology: #GTRIG ml tree
+	if fast:
+		assert not GTRIG_topology and user_tree_file is None, "The fast mode does not support a fixed topology"
+		opt_phyml_stats_filepath, opt_phyml_tree_filepath = distance_tree.compute_fast_gtrig_features(msa, msa_file)
+	elif GTRIG_topology: #GTRIG ml tree
 		opt_phyml_stats_filepath, opt_phyml_tree_filepath = phyml.run_phyml(msa_file, opt_rates_model, topology="ml")
 
 	elif user_tree_file is not None: #user tree
@@ -110,19 +185,17 @@ def extract_features(msa, msa_file, GTRIG_topology, user_tree_file):
 		opt_phyml_stats_filepath, opt_phyml_tree_filepath = phyml.run_phyml(msa_file, opt_rates_model, topology="rates",
 		                                                                    run_id="rates_" + opt_rates_model)
 
-	a_tree, tree_features_dict = compute_tree_features(opt_phyml_stats_filepath, opt_phyml_tree_filepath,
+	features_tree_filepath = opt_phyml_tree_filepath
+	if duplicates:
+		features_tree_filepath = tree_functions.write_tree_with_duplicates(opt_phyml_tree_filepath, duplicates)
+	a_tree, tree_features_dict = compute_tree_features(opt_phyml_stats_filepath, features_tree_filepath,
 	                                                   feat_prefix=opt_rates_model + "_")
 
 	# compute MSA features for sequences without "outgroup" (set according to largest branch)
-	outgroup_leaves, ingroup_leaves = \
-		tree_functions.get_internal_and_external_leaves_relative_to_subroot \
-			(a_tree, tree_functions.get_largest_branch(a_tree))
-	if len(outgroup_leaves) > len(ingroup_leaves):
-		ingroup_leaves, outgroup_leaves = outgroup_leaves, ingroup_leaves
-	ingroup_names = [leaf.name for leaf in ingroup_leaves]
+	ingroup_names, reduced_rows = get_reduced_msa_sequences(a_tree, duplicates)
 	reduced_msa = msa_functions.reduce_msa_to_seqs_by_name(msa, ingroup_names)
 
-	rmsa_features_dict = calculate_alignment_features(reduced_msa, reduced=True)
+	rmsa_features_dict = calculate_alignment_features(reduced_msa, reduced=True, rows=reduced_rows)
 
 	sample = {}
 	sample["ntaxa"], sample["nchars"] = ntaxa, nchars
@@ -133,9 +206,12 @@ def extract_features(msa, msa_file, GTRIG_topology, user_tree_file):
 	return sample, opt_phyml_tree_filepath
 
 
-def prepare_features_df(msa, msa_filepath, GTRIG_topology, user_tree_file):
-	all_features, features_tree_file = extract_features(msa, msa_filepath, GTRIG_topology, user_tree_file)
-	samples_df = pd.DataFrame(all_features, index=[0])
+def expand_samples_to_models(samples_df):
+	"""
+	:param samples_df: a dataframe with the features of a sample per row
+	:return: a dataframe with a row per sample and candidate model, "index" is the row of the sample in samples_df
+	"""
+	samples_df = samples_df.reset_index(drop=True)
 	models = ALL_PHYML_MODELS * len(samples_df)
 	ext_df = samples_df.append([samples_df] * 23)
 	ext_df.sort_index(inplace=True)
@@ -147,4 +223,12 @@ def prepare_features_df(msa, msa_filepath, GTRIG_topology, user_tree_file):
 	ext_df["base_freqs_entropy"] = (np.log2(ext_df[["freq_A", "freq_C", "freq_G", "freq_T"]]) *
 	                                ext_df[["freq_A", "freq_C", "freq_G", "freq_T"]]).sum(axis=1) * -1
 
+	return ext_df
+
+
+def prepare_features_df(msa, msa_filepath, GTRIG_topology, user_tree_file, duplicates=None, fast=False, rows=None):
+	all_features, features_tree_file = extract_features(msa, msa_filepath, GTRIG_topology, user_tree_file, duplicates,
+	                                                    fast, rows)
+	ext_df = expand_samples_to_models(pd.DataFrame(all_features, index=[0]))
+
 	return ext_df, features_tree_file
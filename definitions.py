@@ -1,4 +1,4 @@
-import argparse, os, sys, re, logging, itertools, shutil, math, copy
+import argparse, os, sys, re, logging, itertools, shutil, math, copy, socket, threading, time, gzip, bz2, lzma
 import pandas as pd
 import numpy as np
 from Bio import AlignIO
@@ -12,6 +12,7 @@ script_dir = os.path.dirname(__file__)
 MODELTELLER_RF_MODEL = os.path.join(script_dir, 'rf_models','ModelTeller_model.pkl')
 MODELTELLERg_RF_MODEL = os.path.join(script_dir, 'rf_models','ModelTellerG_model.pkl')
 PHYML_SCRIPT = os.path.join(script_dir, "phyml_exe", "PhyML_3.0_linux64")
+PHYML_MIN_BRANCH_LENGTH = 1e-8  # phyml never estimates shorter branches, also between identical sequences
 
 
 BASE_MODELS = ["JC", "F81", "K80", "HKY", "SYM", "GTR"]
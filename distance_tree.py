@@ -0,0 +1,220 @@
+from scipy import optimize, special, stats
+
+from definitions import *
+import msa_functions
+
+
+FAST_MAX_ITERATIONS = 50  # bound on the optimization iterations of the GTR+I+G parameters
+GAMMA_CATEGORIES = 4
+# conditional likelihoods of the tips, by nucleotide code (see msa_functions.NUCLEOTIDE_CODES). gaps and
+# non-ACGT characters are missing data
+TIP_PARTIALS = np.vstack([np.eye(4), np.ones((1, 4))])
+# fitch state sets of the tips, by nucleotide code
+TIP_STATE_SETS = np.array([1, 2, 4, 8, 15], dtype=np.uint8)
+
+
+def build_bionj_tree(distances, names):
+	"""
+	Gascuel, Olivier. "BIONJ: an improved version of the NJ algorithm based on a simple model of sequence data."
+	 Molecular biology and evolution 14.7 (1997): 685-695.
+	:param distances: a symmetric distance matrix
+	:param names: the taxa names, by the order of distances
+	:return: an unrooted ete3 tree (trifurcation at the root), negative branch lengths are set to
+	PHYML_MIN_BRANCH_LENGTH
+	"""
+	distances = np.array(distances, dtype=float)
+	variances = distances.copy()
+	nodes = [Tree(name=name) for name in names]
+	if len(nodes) < 3:
+		tree = Tree()
+		for node, dist in zip(nodes, [distances[0, -1] / 2] * len(nodes)):
+			tree.add_child(node, dist=max(dist, PHYML_MIN_BRANCH_LENGTH))
+		return tree
+
+	while len(nodes) > 3:
+		r = len(nodes)
+		sums = distances.sum(axis=1)
+		q_matrix = (r - 2) * distances - sums[:, None] - sums[None, :]
+		np.fill_diagonal(q_matrix, np.inf)
+		i, j = np.unravel_index(np.argmin(q_matrix), q_matrix.shape)
+		bl_i = 0.5 * (distances[i, j] + (sums[i] - sums[j]) / (r - 2))
+		bl_j = distances[i, j] - bl_i
+
+		others = [k for k in range(r) if k != i and k != j]
+		if variances[i, j] == 0:
+			lambda_ij = 0.5
+		else:
+			lambda_ij = 0.5 + np.sum(variances[j, others] - variances[i, others]) / (2 * (r - 2) * variances[i, j])
+			lambda_ij = min(max(lambda_ij, 0), 1)
+		new_distances = lambda_ij * (distances[i, others] - bl_i) + (1 - lambda_ij) * (distances[j, others] - bl_j)
+		new_variances = lambda_ij * variances[i, others] + (1 - lambda_ij) * variances[j, others] - \
+		                lambda_ij * (1 - lambda_ij) * variances[i, j]
+
+		new_node = Tree()
+		new_node.add_child(nodes[i], dist=max(bl_i, PHYML_MIN_BRANCH_LENGTH))
+		new_node.add_child(nodes[j], dist=max(bl_j, PHYML_MIN_BRANCH_LENGTH))
+		nodes = [nodes[k] for k in others] + [new_node]
+		distances = np.vstack([np.column_stack([distances[np.ix_(others, others)], new_distances]),
+		                       np.append(new_distances, 0)])
+		variances = np.vstack([np.column_stack([variances[np.ix_(others, others)], new_variances]),
+		                       np.append(new_variances, 0)])
+
+	tree = Tree()
+	for a, b, c in [(0, 1, 2), (1, 0, 2), (2, 0, 1)]:
+		tree.add_child(nodes[a], dist=max((distances[a, b] + distances[a, c] - distances[b, c]) / 2,
+		                                  PHYML_MIN_BRANCH_LENGTH))
+	return tree
+
+
+def compute_gamma_rates(alpha, ncat=GAMMA_CATEGORIES):
+	"""
+	:return: the mean rate of every category of the discrete gamma distribution (Yang 1994), as in phyml
+	"""
+	bounds = stats.gamma.ppf(np.arange(1, ncat) / ncat, a=alpha, scale=1 / alpha)
+	cdf = special.gammainc(alpha + 1, np.concatenate([[0], bounds * alpha, [np.inf]]))
+	return np.diff(cdf) * ncat
+
+
+def get_rate_matrix(rel_rates, freqs):
+	"""
+	:param rel_rates: the AC, AG, AT, CG, CT, GT exchangeabilities
+	:param freqs: the A, C, G, T frequencies
+	:return: the instantaneous rate matrix normalized to one substitution per unit time, and the normalization factor
+	"""
+	exchangeabilities = np.zeros((4, 4))
+	exchangeabilities[np.triu_indices(4, 1)] = rel_rates
+	exchangeabilities += exchangeabilities.T
+	rate_matrix = exchangeabilities * freqs[None, :]
+	np.fill_diagonal(rate_matrix, -rate_matrix.sum(axis=1))
+	mu = 1 / -np.sum(freqs * np.diag(rate_matrix))
+	return rate_matrix * mu, mu
+
+
+def get_transition_matrices(rate_matrix, freqs, times):
+	"""
+	:param times: array of branch lengths multiplied by rates, of any shape
+	:return: array of shape times.shape + (4, 4) of P(t)=exp(Qt), computed from the symmetrized rate matrix
+	"""
+	sqrt_freqs = np.sqrt(freqs)
+	eigenvalues, eigenvectors = np.linalg.eigh(rate_matrix * sqrt_freqs[:, None] / sqrt_freqs[None, :])
+	left = eigenvectors / sqrt_freqs[:, None]
+	right = eigenvectors.T * sqrt_freqs[None, :]
+	return np.einsum("ik,...k,kj->...ij", left, np.exp(np.multiply.outer(times, eigenvalues)), right)
+
+
+def get_postorder(tree, names):
+	"""
+	:return: list of (node, children indexes, msa row of a leaf) in postorder, and the branch lengths by that order
+	"""
+	rows = {name: row for row, name in enumerate(names)}
+	nodes = list(tree.traverse(strategy="postorder"))
+	indexes = {node: i for i, node in enumerate(nodes)}
+	postorder = [(node, [indexes[child] for child in node.children], rows.get(node.name) if node.is_leaf() else None)
+	             for node in nodes]
+	return postorder, np.array([node.dist for node in nodes])
+
+
+def compute_log_likelihood(postorder, branch_lengths, codes, counts, rel_rates, freqs, alpha, pinv):
+	"""
+	felsenstein's pruning over the site patterns, with gamma categories and invariable sites as in phyml
+	(the gamma rates are divided by 1-pinv so the mean rate remains 1)
+	:param codes: nucleotide codes of the site patterns, shape (ntaxa, npatterns)
+	:param counts: the number of sites of every pattern
+	"""
+	rate_matrix, _ = get_rate_matrix(rel_rates, freqs)
+	rates = compute_gamma_rates(alpha) / (1 - pinv)
+	transition_matrices = get_transition_matrices(rate_matrix, freqs, np.multiply.outer(branch_lengths, rates))
+
+	# P(t) with an additional column of ones, the probability of a missing character, to be indexed by tip codes
+	tip_transition_matrices = np.concatenate([transition_matrices, np.ones(transition_matrices.shape[:-1] + (1,))],
+	                                         axis=-1)
+	partials = [None] * len(postorder)
+	log_scalers = np.zeros(codes.shape[1])
+	for i, (node, children, row) in enumerate(postorder):
+		if row is not None:
+			continue
+		node_partials = 1
+		for child in children:
+			child_row = postorder[child][2]
+			if child_row is not None:
+				node_partials = node_partials * tip_transition_matrices[child][:, :, codes[child_row]].transpose(0, 2, 1)
+			else:
+				node_partials = node_partials * (partials[child] @ transition_matrices[child].transpose(0, 2, 1))
+				partials[child] = None
+		scaler = node_partials.max(axis=(0, 2))
+		scaler[scaler == 0] = 1
+		partials[i] = node_partials / scaler[None, :, None]
+		log_scalers += np.log(scaler)
+
+	gamma_likelihoods = (partials[-1] @ freqs).mean(axis=0)
+	with np.errstate(divide="ignore"):
+		log_sites_likelihoods = np.log((1 - pinv) * gamma_likelihoods) + log_scalers
+		if pinv > 0:
+			invariant_likelihoods = np.prod(TIP_PARTIALS[codes], axis=0) @ freqs
+			log_sites_likelihoods = np.logaddexp(log_sites_likelihoods, np.log(pinv * invariant_likelihoods))
+	return np.sum(counts * log_sites_likelihoods)
+
+
+def compute_parsimony(postorder, codes, counts):
+	"""
+	:return: fitch parsimony score of the tree, multifurcations are resolved in the children order
+	"""
+	state_sets = [None] * len(postorder)
+	score = 0
+	for i, (node, children, row) in enumerate(postorder):
+		if row is not None:
+			state_sets[i] = TIP_STATE_SETS[codes[row]]
+			continue
+		node_set = state_sets[children[0]]
+		for child in children[1:]:
+			intersection = node_set & state_sets[child]
+			score += np.sum(counts[intersection == 0])
+			node_set = np.where(intersection == 0, node_set | state_sets[child], intersection)
+		state_sets[i] = node_set
+	return int(score)
+
+
+def fit_gtrig_parameters(postorder, branch_lengths, codes, counts, freqs, max_iterations=FAST_MAX_ITERATIONS):
+	"""
+	optimizes the GTR exchangeabilities (GT fixed to 1), the gamma shape and the proportion of invariable sites
+	on a fixed tree with fixed branch lengths and frequencies
+	:return: rel_rates, alpha, pinv, log-likelihood
+	"""
+	def negative_log_likelihood(params):
+		return -compute_log_likelihood(postorder, branch_lengths, codes, counts,
+		                               np.append(params[:5], 1), freqs, params[5], params[6])
+
+	res = optimize.minimize(negative_log_likelihood, x0=[1, 1, 1, 1, 1, 0.5, 0.1], method="L-BFGS-B",
+	                        bounds=[(1e-3, 100)] * 5 + [(0.02, 100), (0, 0.99)],
+	                        options={"maxiter": max_iterations})
+	return np.append(res.x[:5], 1), res.x[5], res.x[6], -res.fun
+
+
+def compute_fast_gtrig_features(msa, msa_filepath, max_iterations=FAST_MAX_ITERATIONS):
+	"""
+	fast approximation of the phyml GTR+I+G "rates" run: a BioNJ tree of JC distances, and GTR+I+G parameters fitted
+	on that tree in-process
+	:param msa: bio.AlignIO format
+	:param msa_filepath: the tree is written to msa_filepath + "_fast_tree_GTR+I+G.txt"
+	:return: a dictionary with the keys of phyml.parse_phyml_stats_file, and the tree filepath
+	"""
+	names = [rec.id for rec in msa]
+	tree = build_bionj_tree(msa_functions.compute_pairwise_distances(msa), names)
+	tree_filepath = msa_filepath + "_fast_tree_GTR+I+G.txt"
+	tree.write(format=1, outfile=tree_filepath)
+
+	patterns, counts = msa_functions.get_site_patterns(msa)
+	codes = msa_functions.NUCLEOTIDE_CODES[patterns]
+	freqs = msa_functions.compute_base_frequencies(msa)
+	freqs = np.array([freqs["freq_" + nuc] for nuc in "ACGT"])
+	postorder, branch_lengths = get_postorder(tree, names)
+	rel_rates, alpha, pinv, log_likelihood = fit_gtrig_parameters(postorder, branch_lengths, codes, counts, freqs,
+	                                                              max_iterations)
+	rate_matrix, mu = get_rate_matrix(rel_rates, freqs)
+
+	res_dict = {"parsimony": compute_parsimony(postorder, codes, counts), "tree_size": float(np.sum(branch_lengths[:-1])),
+	            "pInv": pinv, "gamma": alpha, "Tstv": "", "logL": log_likelihood, "mu_rate": mu}
+	res_dict.update({"f" + nuc: freq for nuc, freq in zip("ACGT", freqs)})
+	res_dict.update({"rel_sub" + subs: rate for subs, rate in zip(msa_functions.SUBS_PAIRS, rel_rates)})
+	res_dict.update(zip(["sub" + x + y for x, y in itertools.product('ACGT', repeat=2)], rate_matrix.flatten()))
+	return res_dict, tree_filepath
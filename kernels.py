@@ -0,0 +1,236 @@
+import warnings
+
+from definitions import *
+
+try:
+	import numba
+except ImportError:
+	numba = None
+
+
+KERNELS_ENV_VAR = "MODELTELLER_KERNELS"  # "numpy", "numba" or "auto" (default): numba if it is installed
+# the counts of count_packed_substitutions, as in msa_functions.infer_pairwise_substitution_matrix
+PACKED_COUNTS = ["AC", "AG", "AT", "CG", "CT", "GT", "AA", "CC", "GG", "TT", "1s", "2s", "pa_length"]
+# masks of the SWAR popcount, see count_set_bits
+POPCOUNT_M1, POPCOUNT_M2, POPCOUNT_M4, POPCOUNT_H01 = [np.uint64(mask) for mask in [
+	0x5555555555555555, 0x3333333333333333, 0x0f0f0f0f0f0f0f0f, 0x0101010101010101]]
+# remove_gaps_from_sequence passes re.I (== 2) as the count argument of re.sub, so only the first two runs of
+# non-ACGT characters of a column are removed. the kernels keep this behavior so that the features do not change
+GAP_RUNS_REMOVED = int(re.I)
+NON_ACGT_CHARS = np.ones(256, dtype=np.bool_)
+for nuc in "ACGTacgt":
+	NON_ACGT_CHARS[ord(nuc)] = False
+
+
+################################ numpy reference kernels ################################
+
+def count_set_bits(words):
+	"""
+	:param words: uint64 array of shape (nrows, nwords)
+	:return: the number of set bits in every row
+	"""
+	if hasattr(np, "bitwise_count"):  # numpy >= 2.0
+		return np.bitwise_count(words).sum(axis=1, dtype=np.int64)
+	# SWAR popcount of every word, in place of a lookup table that would widen every byte
+	words = words - ((words >> np.uint64(1)) & POPCOUNT_M1)
+	words = (words & POPCOUNT_M2) + ((words >> np.uint64(2)) & POPCOUNT_M2)
+	words = (words + (words >> np.uint64(4))) & POPCOUNT_M4
+	return ((words * POPCOUNT_H01) >> np.uint64(56)).sum(axis=1, dtype=np.int64)
+
+
+def count_packed_substitutions_numpy(hi1, lo1, valid1, hi, lo, valid, nchars):
+	"""
+	:param hi1, lo1, valid1: uint64 arrays of shape (nwords,), the bit planes of a sequence, see msa_functions.pack_msa
+	:param hi, lo, valid: uint64 arrays of shape (nseqs, nwords), the bit planes of the sequences to compare it to
+	:param nchars: the alignment length
+	:return: int array of shape (len(PACKED_COUNTS), nseqs) with the counts of every pair
+	"""
+	hi_diff, lo_diff = hi1 ^ hi, lo1 ^ lo
+	both_nucs = valid1 & valid
+	transitions = both_nucs & ~lo_diff & hi_diff
+	transversions = both_nucs & lo_diff
+	matches = both_nucs & ~hi_diff & ~lo_diff
+	return np.stack([count_set_bits(transversions & ~hi_diff & ~hi1), count_set_bits(transitions & ~lo1),
+	                 count_set_bits(transversions & hi_diff & ~(hi1 ^ lo1)),
+	                 count_set_bits(transversions & hi_diff & (hi1 ^ lo1)), count_set_bits(transitions & lo1),
+	                 count_set_bits(transversions & ~hi_diff & hi1),
+	                 count_set_bits(matches & ~hi1 & ~lo1), count_set_bits(matches & ~hi1 & lo1),
+	                 count_set_bits(matches & hi1 & ~lo1), count_set_bits(matches & hi1 & lo1),
+	                 count_set_bits(valid1 ^ valid), nchars - count_set_bits(valid1 | valid), count_set_bits(both_nucs)])
+
+
+def accumulate_postorder_numpy(children, dists):
+	"""
+	:param children: int array of shape (nnodes, 2) of the indexes of the first two children of every node, -1 for
+	leaves. the nodes are in postorder
+	:param dists: the branch length of every node
+	:return: the sum of the branch lengths and the height of the subtree of every node. the nodes are computed by
+	levels (the number of edges to the farthest leaf), all the nodes of a level at once
+	"""
+	# the children precede their parent in postorder, so the levels are computed in a single pass
+	levels = [0] * len(children)
+	for node, (child0, child1) in enumerate(children.tolist()):
+		if child0 >= 0:
+			levels[node] = max(levels[child0], levels[child1]) + 1
+	levels = np.array(levels, dtype=np.int64)
+	nodes_by_level = np.argsort(levels, kind="stable")
+	level_ends = np.cumsum(np.bincount(levels))
+
+	subtree_blsum = np.zeros(len(children))
+	heights = np.zeros(len(children))
+	for level in range(1, len(level_ends)):
+		nodes = nodes_by_level[level_ends[level - 1]:level_ends[level]]
+		child0, child1 = children[nodes, 0], children[nodes, 1]
+		subtree_blsum[nodes] = subtree_blsum[child0] + subtree_blsum[child1] + dists[child0] + dists[child1]
+		heights[nodes] = np.maximum(heights[child0] + dists[child0], heights[child1] + dists[child1])
+	return subtree_blsum, heights
+
+
+def find_first_nonzero_rate_numpy(matrix):
+	"""
+	:param matrix: a 4x4 rate matrix
+	:return: the row and column of the first non-zero rate above the diagonal, row by row
+	"""
+	rows, cols = np.triu_indices(4, 1)
+	first = np.flatnonzero(matrix[rows, cols] != 0)[0]
+	return rows[first], cols[first]
+
+
+def get_gapless_mask_numpy(chars):
+	"""
+	:param chars: uint8 array of shape (ntaxa, ncols) of ascii codes, see msa_functions.get_msa_chars
+	:return: boolean array, True for the characters of every column that remove_gaps_from_sequence keeps
+	"""
+	gaps = NON_ACGT_CHARS[chars]
+	run_starts = gaps.copy()
+	run_starts[1:] &= ~gaps[:-1]
+	return ~gaps | (np.cumsum(run_starts, axis=0) > GAP_RUNS_REMOVED)
+
+
+BACKENDS = {"numpy": {"count_packed_substitutions": count_packed_substitutions_numpy,
+                      "accumulate_postorder": accumulate_postorder_numpy,
+                      "find_first_nonzero_rate": find_first_nonzero_rate_numpy,
+                      "get_gapless_mask": get_gapless_mask_numpy}}
+
+
+################################ numba kernels ################################
+# the same computations as the numpy kernels, as compiled loops
+
+if numba is not None:
+	@numba.njit(cache=True)
+	def popcount_numba(word):
+		word = word - ((word >> np.uint64(1)) & POPCOUNT_M1)
+		word = (word & POPCOUNT_M2) + ((word >> np.uint64(2)) & POPCOUNT_M2)
+		word = (word + (word >> np.uint64(4))) & POPCOUNT_M4
+		return np.int64((word * POPCOUNT_H01) >> np.uint64(56))
+
+
+	@numba.njit(cache=True)
+	def count_packed_substitutions_numba(hi1, lo1, valid1, hi, lo, valid, nchars):
+		counts = np.zeros((13, hi.shape[0]), dtype=np.int64)  # by the order of PACKED_COUNTS
+		for seq in range(hi.shape[0]):
+			for word in range(hi.shape[1]):
+				h1, l1, v1 = hi1[word], lo1[word], valid1[word]
+				hi_diff, lo_diff = h1 ^ hi[seq, word], l1 ^ lo[seq, word]
+				both_nucs = v1 & valid[seq, word]
+				transitions = both_nucs & ~lo_diff & hi_diff
+				transversions = both_nucs & lo_diff
+				matches = both_nucs & ~hi_diff & ~lo_diff
+				counts[0, seq] += popcount_numba(transversions & ~hi_diff & ~h1)
+				counts[1, seq] += popcount_numba(transitions & ~l1)
+				counts[2, seq] += popcount_numba(transversions & hi_diff & ~(h1 ^ l1))
+				counts[3, seq] += popcount_numba(transversions & hi_diff & (h1 ^ l1))
+				counts[4, seq] += popcount_numba(transitions & l1)
+				counts[5, seq] += popcount_numba(transversions & ~hi_diff & h1)
+				counts[6, seq] += popcount_numba(matches & ~h1 & ~l1)
+				counts[7, seq] += popcount_numba(matches & ~h1 & l1)
+				counts[8, seq] += popcount_numba(matches & h1 & ~l1)
+				counts[9, seq] += popcount_numba(matches & h1 & l1)
+				counts[10, seq] += popcount_numba(v1 ^ valid[seq, word])
+				counts[11, seq] += popcount_numba(v1 | valid[seq, word])
+				counts[12, seq] += popcount_numba(both_nucs)
+			counts[11, seq] = nchars - counts[11, seq]
+		return counts
+
+
+	@numba.njit(cache=True)
+	def accumulate_postorder_numba(children, dists):
+		subtree_blsum = np.zeros(len(children))
+		heights = np.zeros(len(children))
+		for node in range(len(children)):
+			child0, child1 = children[node, 0], children[node, 1]
+			if child0 < 0:
+				continue
+			subtree_blsum[node] = subtree_blsum[child0] + subtree_blsum[child1] + dists[child0] + dists[child1]
+			heights[node] = max(heights[child0] + dists[child0], heights[child1] + dists[child1])
+		return subtree_blsum, heights
+
+
+	@numba.njit(cache=True)
+	def find_first_nonzero_rate_numba(matrix):
+		for row in range(4):
+			for col in range(row + 1, 4):
+				if matrix[row, col] != 0:
+					return row, col
+		raise IndexError("All the rates are zero")
+
+
+	@numba.njit(cache=True)
+	def get_gapless_mask_numba(chars):
+		mask = np.empty(chars.shape, dtype=np.bool_)
+		for col in range(chars.shape[1]):
+			gap_runs = 0
+			prev_gap = False
+			for row in range(chars.shape[0]):
+				gap = NON_ACGT_CHARS[chars[row, col]]
+				if gap and not prev_gap:
+					gap_runs += 1
+				mask[row, col] = not gap or gap_runs > GAP_RUNS_REMOVED
+				prev_gap = gap
+		return mask
+
+
+	BACKENDS["numba"] = {"count_packed_substitutions": count_packed_substitutions_numba,
+	                     "accumulate_postorder": accumulate_postorder_numba,
+	                     "find_first_nonzero_rate": find_first_nonzero_rate_numba,
+	                     "get_gapless_mask": get_gapless_mask_numba}
+
+
+################################ backend selection ################################
+
+def set_backend(backend="auto"):
+	"""
+	:param backend: "numpy", "numba", or "auto" - numba if it is installed, numpy otherwise. if numba is requested
+	but is not installed, falls back to numpy with a warning
+	:return: the name of the selected backend
+	"""
+	global current_backend
+	if backend == "auto":
+		backend = "numba" if "numba" in BACKENDS else "numpy"
+	elif backend == "numba" and "numba" not in BACKENDS:
+		warnings.warn("numba is not installed, using the numpy kernels")
+		backend = "numpy"
+	elif backend not in BACKENDS:
+		raise ValueError("Unknown kernels backend: " + backend)
+	current_backend = backend
+	return backend
+
+
+def count_packed_substitutions(hi1, lo1, valid1, hi, lo, valid, nchars):
+	return BACKENDS[current_backend]["count_packed_substitutions"](hi1, lo1, valid1, hi, lo, valid, nchars)
+
+
+def accumulate_postorder(children, dists):
+	return BACKENDS[current_backend]["accumulate_postorder"](children, dists)
+
+
+def find_first_nonzero_rate(matrix):
+	return BACKENDS[current_backend]["find_first_nonzero_rate"](matrix)
+
+
+def get_gapless_mask(chars):
+	return BACKENDS[current_backend]["get_gapless_mask"](chars)
+
+
+current_backend = None
+set_backend(os.environ.get(KERNELS_ENV_VAR, "auto"))
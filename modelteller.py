@@ -1,55 +1,123 @@
+import io
 import pickle
 import traceback
+from concurrent.futures import ProcessPoolExecutor
 
 from definitions import *
 import compute_features
+import msa_functions
 import tree_functions
 from utils import *
 import phyml
+import sharding
+import audit
+import bootstrap
+import partitions
+import kernels
 
-def validate_input(msa_file, user_tree_file):
+LOGGER_NAME = 'ModelTeller main script'
+ALIGNMENT_FORMATS = ["clustal", "emboss", "fasta", "fasta-m10", "ig", "maf", "mauve", "nexus", "phylip-relaxed",
+                     "phylip-sequential", "stockholm"]
+# the first non-blank line of the files of every format
+ALIGNMENT_FORMATS_FIRST_LINES = {"clustal": r"^(CLUSTAL|MUSCLE|PROBCONS)", "emboss": r"^#{10,}\s*$",
+                                 "fasta": r"^>", "fasta-m10": r"^#(?!#|NEXUS|FormatVersion|\s*STOCKHOLM)",
+                                 "ig": r"^;", "maf": r"^(##maf|track\s|a(\s|$))", "mauve": r"^#FormatVersion\s+Mauve",
+                                 "nexus": r"^#NEXUS", "phylip-relaxed": r"^\d+\s+\d+",
+                                 "phylip-sequential": r"^\d+\s+\d+", "stockholm": r"^#\s*STOCKHOLM"}
+FORMAT_DETECTION_CHARS = 64 * 1024
+
+
+def detect_alignment_format(msa_file):
 	"""
-	:param msa_file: the path to an MSA file, one of biopython's formats
-	:param user_tree_file: (optional) the path to a user tree file, if fixed tree was desired
-	:return: a biopython object of the msa and an ete3 object of the tree if exists
+	detects the format from the head of the file (the first FORMAT_DETECTION_CHARS characters, decompressed), so
+	that the file is read in full only once, when it is parsed. the candidate formats are those whose files may
+	start with the first non-blank line of the file (all the formats if none), and the first candidate in which the
+	head is a valid alignment is selected. if the first alignment does not fit in the head, and so is not valid in
+	any of the candidates, the first candidate is selected
+	:return: one of ALIGNMENT_FORMATS, None if the file is not valid in any of them
 	"""
-
-	# identify format and retrieve all MSAs
-	for aln_format in ["clustal", "emboss", "fasta", "fasta-m10", "ig", "maf", "mauve", "nexus", "phylip-relaxed", "phylip-sequential", "stockholm"]:
+	with open_alignment_file(msa_file) as fpr:
+		head = fpr.read(FORMAT_DETECTION_CHARS)
+		complete = not fpr.read(1)
+	first_line = next((line.strip() for line in head.splitlines() if line.strip()), "")
+	candidates = [aln_format for aln_format in ALIGNMENT_FORMATS
+	              if re.match(ALIGNMENT_FORMATS_FIRST_LINES[aln_format], first_line, re.I)] or ALIGNMENT_FORMATS
+	for aln_format in candidates:
 		try:
-			msa_obj = AlignIO.read(msa_file, format=aln_format)
-			logger.info("The MSA file is format: " + aln_format)
-			break
+			next(AlignIO.parse(io.StringIO(head), format=aln_format))
+			return aln_format
 		except Exception:
-			msa_obj = None
-	if msa_obj is None:
+			continue
+	if complete or candidates == ALIGNMENT_FORMATS:
+		return None
+	return candidates[0]
+
+
+def validate_input(msa_file, user_tree_file, aln_format):
+	"""
+	:param msa_file: the path to a file with one or more MSAs, in one of biopython's formats, optionally compressed
+	(gzip, xz or bz2)
+	:param user_tree_file: (optional) the path to a user tree file, if fixed tree was desired
+	:param aln_format: see detect_alignment_format
+	:return: a generator of biopython objects of the MSAs. the file is read (and decompressed) as the MSAs are
+	consumed, every MSA is validated when it is parsed
+	"""
+	with open_alignment_file(msa_file) as fpr:
+		for msa_obj in AlignIO.parse(fpr, format=aln_format):
+			# validate MSA characters
+			msa_info = AlignInfo.SummaryInfo(msa_obj)
+			aln_letters = msa_info._get_all_letters()
+			for let in aln_letters:
+				if not (let.lower() in "acgt-"):
+					logger.warning("There are characters that are not nucleotides or gaps in your input MSA.")
+					break
+
+			# validate tree file in Newick format and suits the msa
+			tree_obj = None
+			if user_tree_file:
+				try:
+					with open(user_tree_file) as tree_fpr:
+						tree_obj = tree_functions.get_newick_tree(tree_fpr.read().strip())
+				except:
+					logger.error("Tree file is invalid. Please verify that it's in Newick format.")
+
+				# assert that the tree matches the corresponding MSA
+				leaves = sorted([node.name for node in tree_obj.get_leaves()])
+				seq_names = sorted([rec.id for rec in msa_obj])
+				if len(leaves) != len(seq_names) or (not all(x == y for x,y  in zip(seq_names,leaves))):
+					logger.error("The tips of the tree and the MSA sequences names do not match")
+
+			yield msa_obj
+
+
+def process_alignments(msa_file, user_tree_file, process_alignment):
+	"""
+	runs process_alignment on every MSA of msa_file, one at a time, as the MSAs are parsed. an MSA that PhyML cannot
+	read from msa_file (a compressed file, a non-PHYLIP format, or not the first MSA of the file) is written to a
+	temporary PHYLIP file, msa_file + "_record<i>.phy", that is removed once it is processed
+	:param process_alignment: a function of the MSA object and the filepath of the MSA for PhyML, that is also the
+	prefix of the outputs
+	"""
+	aln_format = detect_alignment_format(msa_file)
+	if aln_format is None:
 		logger.error("Error occured: the input file is not a valid alignmnet in a supported format.\n"
 		             "Please verify that all sequences are at the same length and that the input format is correct.")
+		raise ValueError("Invalid alignment file: " + msa_file)
+	logger.info("The MSA file is format: " + aln_format)
 
-	# validate MSA characters
-	msa_info = AlignInfo.SummaryInfo(msa_obj)
-	aln_letters = msa_info._get_all_letters()
-	for let in aln_letters:
-		if not (let.lower() in "acgt-"):
-			logger.warning("There are characters that are not nucleotides or gaps in your input MSA.")
-			break
+	phyml_readable = aln_format.startswith("phylip") and get_decompression_opener(msa_file) is None
+	for record_i, msa_obj in enumerate(validate_input(msa_file, user_tree_file, aln_format), start=1):
+		if record_i == 1 and phyml_readable:
+			process_alignment(msa_obj, msa_file)
+			continue
 
-	# validate tree file in Newick format and suits the msa
-	tree_obj = None
-	if user_tree_file:
+		logger.info("Processing MSA #" + str(record_i) + " of " + msa_file)
+		record_filepath = msa_file + "_record" + str(record_i) + ".phy"
+		AlignIO.write(msa_obj, record_filepath, "phylip-relaxed")
 		try:
-			with open(user_tree_file) as fpr:
-				tree_obj = tree_functions.get_newick_tree(fpr.read().strip())
-		except:
-			logger.error("Tree file is invalid. Please verify that it's in Newick format.")
-
-		# assert that the tree matches the corresponding MSA
-		leaves = sorted([node.name for node in tree_obj.get_leaves()])
-		seq_names = sorted([rec.id for rec in msa_obj])
-		if len(leaves) != len(seq_names) or (not all(x == y for x,y  in zip(seq_names,leaves))):
-			logger.error("The tips of the tree and the MSA sequences names do not match")
-
-	return msa_obj
+			process_alignment(msa_obj, record_filepath)
+		finally:
+			os.remove(record_filepath)
 
 
 def predict_sklearn(ext_df, rf_model_path):
@@ -65,61 +133,234 @@ def predict_sklearn(ext_df, rf_model_path):
 	return
 
 
-def main(msa_obj, msa_filepath, GTRIG_topology, user_tree_file):
+def collapse_msa_duplicates(msa_obj, msa_filepath, user_tree_file):
+	"""
+	writes the distinct sequences of the msa for PhyML, and prunes the identical ones from the user tree
+	:return: the msa, its filepath and the user tree file for PhyML, and the duplicates and rows (see
+	msa_functions.collapse_duplicate_sequences), None if there are no identical sequences
+	"""
+	unique_msa_obj, duplicates, rows = msa_functions.collapse_duplicate_sequences(msa_obj)
+	if len(unique_msa_obj) == len(msa_obj):
+		return msa_obj, msa_filepath, user_tree_file, None, None
+
+	logger.info("Collapsed " + str(len(msa_obj)) + " sequences into " + str(len(unique_msa_obj)) + " distinct ones")
+	unique_msa_filepath = msa_filepath + "_unique.phy"
+	AlignIO.write(unique_msa_obj, unique_msa_filepath, "phylip-relaxed")
+	if user_tree_file:
+		unique_user_tree_file = unique_msa_filepath + "_user_tree.txt"
+		tree_functions.prune_duplicate_tips(user_tree_file, duplicates).write(format=1, outfile=unique_user_tree_file)
+		user_tree_file = unique_user_tree_file
+	return unique_msa_obj, unique_msa_filepath, user_tree_file, duplicates, rows
+
+
+def get_rf_model_path(GTRIG_topology):
+	if not GTRIG_topology:
+		return MODELTELLER_RF_MODEL
+	else:
+		return MODELTELLERg_RF_MODEL
+
+
+def main(msa_obj, msa_filepath, GTRIG_topology, user_tree_file, collapse_duplicates=False, fast=False,
+         run_audit=False, cpus=None, n_bootstrap=0):
 	"""
 	:param msa_obj: a biopython.AlignIO obj of the input MSA
 	:param GTRIG_topology: True - compute GTR+I+G ml tree and fix the topology for ModelTeller computation, else --
 	:param user_tree_file: if GTR+I+G is False, use the given topology for ModelTeller computation, if None --
 	If both GTRIG_topology and user_tree_file topology are empty, compute a ml tree for a single model
+	:param collapse_duplicates: True - run PhyML on the distinct sequences only, and reinsert the identical ones
+	:param fast: True - approximate the GTR+I+G features with an in-process BioNJ tree instead of a PhyML run
+	:param run_audit: True - run PhyML with all the candidate models, on up to cpus cpus, and tabulate their fit
+	:param n_bootstrap: the number of bootstrap replicates of the MSA sites for estimating the prediction stability
 	:return:
 	"""
-	ext_df, features_tree_file = compute_features.prepare_features_df(msa_obj, msa_filepath, GTRIG_topology, user_tree_file)
-	if not GTRIG_topology:
-		rf_model_path = MODELTELLER_RF_MODEL
-	else:
-		rf_model_path = MODELTELLERg_RF_MODEL
+	duplicates, rows = None, None
+	phyml_msa_filepath = msa_filepath
+	if collapse_duplicates:
+		msa_obj, phyml_msa_filepath, user_tree_file, duplicates, rows = \
+			collapse_msa_duplicates(msa_obj, msa_filepath, user_tree_file)
 
+	ext_df, features_tree_file = compute_features.prepare_features_df(msa_obj, phyml_msa_filepath, GTRIG_topology,
+	                                                                  user_tree_file, duplicates, fast, rows)
+	rf_model_path = get_rf_model_path(GTRIG_topology)
 	predict_sklearn(ext_df, rf_model_path)
 
 	probs_df = ext_df.pivot(index='index', columns='model', values='pred_Bs')[ALL_PHYML_MODELS]
 	ranked_df = pd.DataFrame.rank(probs_df, axis=1, method="min")
 	ext_df["model_rank"] = ranked_df.stack().values
 
+	if n_bootstrap:
+		logger.info("Predicting for " + str(n_bootstrap) + " bootstrap replicates of the MSA sites...")
+		sample = ext_df.drop(["index", "model", "pred_Bs", "model_rank"], axis=1).iloc[0].to_dict()
+		replicates_ext_df = compute_features.expand_samples_to_models(
+			bootstrap.compute_replicates_features(msa_obj, sample, features_tree_file, n_bootstrap, duplicates,
+			                                      rows))
+		predict_sklearn(replicates_ext_df, rf_model_path)
+		rank1_frequencies = bootstrap.get_rank1_frequencies(replicates_ext_df)
+		bootstrap_filepath = msa_filepath + "bootstrap_rank1_frequencies.csv"
+		write_csv_atomically(rank1_frequencies.rename("rank1_frequency").to_frame(), bootstrap_filepath)
+		logger.info("The selected model was ranked first in {:.0%} of the bootstrap replicates. All frequencies are in: {}"
+		            .format(rank1_frequencies[ext_df.loc[ext_df["model_rank"]==1, "model"].to_list()[0]],
+		                    bootstrap_filepath))
+
 	# save features nicely
 	ext_df.drop(["model_matrix", "model_F", "model_I", "model_G"], inplace=True, axis=1)
 	ext_df.rename(mapper=FEATURE_NAMES_MAPPING, axis="columns", inplace=True)
-	ext_df.to_csv(msa_filepath + "features_with_models_rankings.csv")
+	write_csv_atomically(ext_df, msa_filepath + "features_with_models_rankings.csv")
 
 	selected_model = ext_df.loc[ext_df["model_rank"]==1, "model"].to_list()[0] # in case there multiple minimals, take the first
 	logger.info("Success: ModelTeller selected model is: " + selected_model)
 
-	logger.info("Now computing the final phylogeny... Please wait until PhyML is done.")
-
 	fixed_tree = None
 	if GTRIG_topology:
 		fixed_tree = features_tree_file
 	elif user_tree_file:
 		fixed_tree = user_tree_file
 
+	if run_audit:
+		logger.info("Running PhyML with all the candidate models for the audit... Please wait until PhyML is done.")
+		ntaxa, nchars = msa_functions.get_msa_properties(msa_obj)
+		audit_df = audit.audit_models(phyml_msa_filepath, ntaxa, nchars, dict(zip(ext_df["model"], ext_df["model_rank"])),
+		                              fixed_tree, cpus)
+		audit_filepath = msa_filepath + "audit_models_table.csv"
+		write_csv_atomically(audit_df, audit_filepath, index=False)
+		logger.info("Audit table is in: " + audit_filepath)
+
+	logger.info("Now computing the final phylogeny... Please wait until PhyML is done.")
+
 	#reconstruct maximum-likelihood tree (with fixed topology if selected)
-	_, opt_phyml_tree_filepath = phyml.run_phyml(msa_filepath, selected_model,
+	_, opt_phyml_tree_filepath = phyml.run_phyml(phyml_msa_filepath, selected_model,
 	                                             topology="fixed" if fixed_tree else "ml",
 	                                             tree_file=fixed_tree)
+	if duplicates:
+		opt_phyml_tree_filepath = tree_functions.write_tree_with_duplicates(opt_phyml_tree_filepath, duplicates)
 
 	logger.info("Done. ML tree is in: " + opt_phyml_tree_filepath)
 
 
+def init_logger():
+	"""
+	sets the logger of the script. also the initializer of the partitions processes, that do not run the __main__
+	block when they are spawned (e.g., on macOS and Windows)
+	"""
+	global logger
+	logger = logging.getLogger(LOGGER_NAME)
+	if not logger.handlers:  # forked processes inherit the configured logger
+		init_commandline_logger(logger)
+
+
+def init_partitions_worker(msa_chars, seq_ids, kernels_backend):
+	"""
+	initializer of the partitions processes
+	:param msa_chars: the characters of the msa (see msa_functions.get_msa_chars), shared by all the partitions that
+	a process computes
+	:param seq_ids: the names of the sequences
+	:param kernels_backend: the kernels backend of the main process, see kernels.set_backend
+	"""
+	global partitions_msa_chars, partitions_seq_ids
+	init_logger()
+	kernels.set_backend(kernels_backend)
+	partitions_msa_chars, partitions_seq_ids = msa_chars, seq_ids
+
+
+def extract_partition_features(partition_i, name, columns, msa_filepath, GTRIG_topology, user_tree_file,
+                               collapse_duplicates, fast):
+	"""
+	runs in a partitions process, see init_partitions_worker
+	:param columns: the columns of the partition, see partitions.get_partition_columns
+	:return: the features of the partition, as compute_features.extract_features
+	"""
+	partition_msa_obj = partitions.get_partition_msa(partitions_seq_ids, partitions_msa_chars, columns)
+	partition_msa_filepath = partitions.get_partition_msa_filepath(msa_filepath, partition_i, name)
+	AlignIO.write(partition_msa_obj, partition_msa_filepath, "phylip-relaxed")
+	duplicates, rows, partition_user_tree_file = None, None, user_tree_file
+	if collapse_duplicates:
+		partition_msa_obj, partition_msa_filepath, partition_user_tree_file, duplicates, rows = \
+			collapse_msa_duplicates(partition_msa_obj, partition_msa_filepath, user_tree_file)
+	features, _ = compute_features.extract_features(partition_msa_obj, partition_msa_filepath, GTRIG_topology,
+	                                               partition_user_tree_file, duplicates, fast, rows)
+	return features
+
+
+def main_partitions(msa_obj, msa_filepath, partitions_filepath, GTRIG_topology, user_tree_file,
+                    collapse_duplicates=False, fast=False, cpus=None):
+	"""
+	selects a model for every partition of a concatenated msa. the features of the partitions are computed
+	concurrently, in up to cpus processes, from the characters matrix of msa_obj
+	:param partitions_filepath: a NEXUS charset block or a RAxML-style partition file (see
+	partitions.parse_partitions_file). the other parameters are as in main, and apply to every partition
+	"""
+	partitions_lst = partitions.parse_partitions_file(partitions_filepath)
+	logger.info("Computing the features of " + str(len(partitions_lst)) + " partitions... Please wait until PhyML is done.")
+
+	msa_chars = msa_functions.get_msa_chars(msa_obj)
+
+	nchars = msa_obj.get_alignment_length()
+	partitions_columns = [partitions.get_partition_columns(slices, nchars) for _, slices in partitions_lst]
+	with ProcessPoolExecutor(max_workers=cpus, initializer=init_partitions_worker,
+	                         initargs=(msa_chars, [rec.id for rec in msa_obj], kernels.current_backend)) as executor:
+		samples = list(executor.map(extract_partition_features, range(1, len(partitions_lst) + 1),
+		                            [name for name, _ in partitions_lst], partitions_columns,
+		                            *[itertools.repeat(arg) for arg in [msa_filepath, GTRIG_topology, user_tree_file,
+		                                                                collapse_duplicates, fast]]))
+
+	# a row per partition ("index") and model, ranked within every partition
+	ext_df = compute_features.expand_samples_to_models(pd.DataFrame(samples))
+	predict_sklearn(ext_df, get_rf_model_path(GTRIG_topology))
+	probs_df = ext_df.pivot(index='index', columns='model', values='pred_Bs')[ALL_PHYML_MODELS]
+	ranked_df = pd.DataFrame.rank(probs_df, axis=1, method="min")
+	ext_df["model_rank"] = ranked_df.stack().values
+	ext_df.insert(0, "partition", [partitions_lst[i][0] for i in ext_df["index"]])
+
+	ext_df.drop(["model_matrix", "model_F", "model_I", "model_G"], inplace=True, axis=1)
+	ext_df.rename(mapper=FEATURE_NAMES_MAPPING, axis="columns", inplace=True)
+	write_csv_atomically(ext_df, msa_filepath + "partitions_features_with_models_rankings.csv")
+
+	# in case there multiple minimals, take the first
+	selected_models = ext_df[ext_df["model_rank"]==1].groupby("index", sort=True)["model"].first().to_list()
+	for (name, _), model in zip(partitions_lst, selected_models):
+		logger.info("Success: ModelTeller selected model for partition " + name + " is: " + model)
+	models_filepath = msa_filepath + "partitions_models.txt"
+	partitions.write_partition_models_file(partitions_lst, selected_models, nchars, models_filepath)
+	logger.info("Done. The partition models file is in: " + models_filepath)
+
+
 if __name__ == '__main__':
-	logger = logging.getLogger('ModelTeller main script')
-	init_commandline_logger(logger)
+	init_logger()
 
 	parser = argparse.ArgumentParser(description='ModelTeller running')
 	parser.add_argument('--msa_filepath', '-m', default=None,
-						help='A file with an alignment or several ones of the same format.')
+						help='A file with an alignment or several ones of the same format, optionally compressed '
+							 '(gzip, xz or bz2).')
 	parser.add_argument('--GTRIG_topology', '-g', action='store_true',
 						help="Reconstruct a maximum-likelihood tree using GTR+I+G model and use this as a fixed topology.")
 	parser.add_argument('--user_tree_file', '-u', default=None,
 						help="Specify your tree file in Newick format and use this tree as a fixed topology.")  # if p=2
+	parser.add_argument('--collapse_duplicates', '-d', action='store_true',
+						help="Run PhyML on the distinct sequences only. Identical sequences are reinserted as "
+							 "zero-length tips, for the tree features and for the final tree.")
+	parser.add_argument('--fast', '-f', action='store_true',
+						help="Approximate the GTR+I+G features in-process, using a BioNJ tree, instead of running "
+							 "PhyML. Much faster, but the prediction may differ (see benchmark_fast_mode.py).")
+	parser.add_argument('--audit', '-a', action='store_true',
+						help="Run PhyML with all the candidate models, and write a table of their ModelTeller ranks "
+							 "next to their PhyML logL, AIC and BIC.")
+	parser.add_argument('--cpus', '-c', type=int, default=None,
+						help="The maximal number of concurrent PhyML runs of the audit or of the partitions. "
+							 "Default: all cpus.")
+	parser.add_argument('--bootstrap', '-b', type=int, default=0,
+						help="The number of bootstrap replicates of the MSA sites, for reporting how often every "
+							 "model is ranked first. The GTR+I+G tree features are not recomputed. Default: 0.")
+	parser.add_argument('--partitions_file', '-p', default=None,
+						help="A NEXUS file with a charset block, or a RAxML-style partition file. Select a model "
+							 "for every partition and write them as a partition file.")
+	parser.add_argument('--kernels', default=None, choices=["auto", "numpy", "numba"],
+						help="The implementation of the computational kernels of the features. Default: the "
+							 "%s environment variable, or auto - numba if it is installed." % kernels.KERNELS_ENV_VAR)
+	parser.add_argument('--shard_dir', '-s', default=None,
+						help="Run as a worker that processes the alignments in this directory. Several workers, "
+							 "on one or more hosts that share the directory, may run concurrently.")
+	parser.add_argument('--lease_timeout', type=int, default=sharding.LEASE_TIMEOUT,
+						help="Seconds without a heartbeat after which the alignment of a dead worker is reclaimed.")
 	args = parser.parse_args()
 
 	GTRIG_topology = args.GTRIG_topology
@@ -128,7 +369,34 @@ if __name__ == '__main__':
 
 	assert bool(GTRIG_topology) != bool(user_tree_file) or not bool(user_tree_file), \
 		"Please select either a GTR+I+G tree or a user-defined topology. ModelTeller cannot accept both"
+	assert not args.fast or not (GTRIG_topology or user_tree_file), \
+		"The fast mode computes its own distance tree and cannot be combined with a fixed topology"
+
+	assert not args.partitions_file or not (args.audit or args.bootstrap or args.shard_dir), \
+		"The partitions mode cannot be combined with an audit, bootstrap replicates or a shard directory"
 
-	msa_obj = validate_input(msa_filepath, user_tree_file)
-	main(msa_obj, msa_filepath, GTRIG_topology, user_tree_file)
+	if args.kernels:
+		kernels.set_backend(args.kernels)
+	logger.info("Using the " + kernels.current_backend + " kernels")
+
+	if args.shard_dir:
+		assert not user_tree_file, "A user-defined topology cannot be shared by all the alignments of a shard directory"
+		sharding.run_worker(args.shard_dir,
+		                    lambda shard_msa_filepath: process_alignments(
+			                    shard_msa_filepath, None,
+			                    lambda msa_obj, record_filepath: main(msa_obj, record_filepath, GTRIG_topology, None,
+			                                                          args.collapse_duplicates, args.fast, args.audit,
+			                                                          args.cpus, args.bootstrap)),
+		                    logger, lease_timeout=args.lease_timeout)
+	elif args.partitions_file:
+		process_alignments(msa_filepath, user_tree_file,
+		                   lambda msa_obj, record_filepath: main_partitions(msa_obj, record_filepath,
+		                                                                    args.partitions_file, GTRIG_topology,
+		                                                                    user_tree_file, args.collapse_duplicates,
+		                                                                    args.fast, args.cpus))
+	else:
+		process_alignments(msa_filepath, user_tree_file,
+		                   lambda msa_obj, record_filepath: main(msa_obj, record_filepath, GTRIG_topology,
+		                                                         user_tree_file, args.collapse_duplicates, args.fast,
+		                                                         args.audit, args.cpus, args.bootstrap))
 
@@ -1,29 +1,35 @@
 from definitions import *
 from utils import *
+import kernels
 
 def remove_gaps_from_sequence(seq):
 	return re.sub("[^agctAGCT]+", "", seq, re.I)
 
 
-def count_fully_conserved_fraction(msa):
+def count_fully_conserved_fraction(msa, rows=None):
 	"""
 	:param msa:
 	:param thresholds: a list of percentages
+	:param rows: (optional) the row in msa of every sequence of the full msa, see collapse_duplicate_sequences
 	:return:  a list - for every percentage, how many sites above this conservation thresholds
 	"""
 	msa_length = msa.get_alignment_length()
-	invariant_sites = 0
-	for col_i in range(0, msa_length):
-		col_gapless = remove_gaps_from_sequence(msa[:,col_i])
-		# if something that is not gaps but not AGCT appears in the column
-		if len(col_gapless) == 0:
-			continue
-		if col_gapless.count(col_gapless[0]) == len(col_gapless):
-			invariant_sites += 1
+	invariant_sites = np.count_nonzero(get_columns_fully_conserved(get_msa_chars(msa, rows)))
 
 	return invariant_sites/msa_length
 
 
+def get_columns_fully_conserved(chars):
+	"""
+	:param chars: uint8 array of shape (ntaxa, ncols) of ascii codes, see get_msa_chars
+	:return: boolean array, True for the columns whose characters, without gaps (see remove_gaps_from_sequence),
+	are all the same
+	"""
+	col_gapless = kernels.get_gapless_mask(chars)
+	first_chars = chars[np.argmax(col_gapless, axis=0), np.arange(chars.shape[1])]
+	return col_gapless.any(axis=0) & ((chars == first_chars) | ~col_gapless).all(axis=0)
+
+
 def calculate_column_entropy(col_string):
 	# column_entropy = - sum(for every nucleotide x) {count(x)*log2(Prob(nuc x in col i))}
 	col_gapless = remove_gaps_from_sequence(col_string).upper()
@@ -40,11 +46,28 @@ def calculate_column_entropy(col_string):
 	return -col_entropy
 
 
-def get_msa_avg_entropy(msa):
+def calculate_columns_entropy(chars):
+	"""
+	calculate_column_entropy of all the columns at once
+	:param chars: uint8 array of shape (ntaxa, ncols) of ascii codes, see get_msa_chars
+	:return: the entropy of every column
+	"""
+	codes = NUCLEOTIDE_CODES[chars]
+	col_gapless = kernels.get_gapless_mask(chars)
+	nuc_counts = np.stack([np.count_nonzero(col_gapless & (codes == nuc_code), axis=0) for nuc_code in range(4)])
+	col_lengths = np.count_nonzero(col_gapless, axis=0)
+	with np.errstate(divide="ignore", invalid="ignore"):
+		entropies = np.where(nuc_counts > 0, nuc_counts * np.log2(nuc_counts / col_lengths), 0)
+	a, c, g, t = entropies
+	return -(a + g + c + t)  # by the order of calculate_column_entropy
+
+
+def get_msa_avg_entropy(msa, rows=None):
+	"""
+	:param rows: (optional) the row in msa of every sequence of the full msa, see collapse_duplicate_sequences
+	"""
 	msa_length = msa.get_alignment_length()
-	sum_entropy = 0
-	for col_i in range(0, msa_length):
-		sum_entropy += calculate_column_entropy(msa[:,col_i])
+	sum_entropy = sum(calculate_columns_entropy(get_msa_chars(msa, rows)).tolist())
 
 	return sum_entropy/msa_length
 
@@ -105,37 +128,175 @@ def compute_pairwise_substitution_rates(seq1, seq2):
 			substitution_count_dictionary["GT"]
 
 
-def compute_base_frequencies(msa):
+# 2-bit nucleotide codes (A=00, C=01, G=10, T=11): transitions (A<->G, C<->T) differ only in the high bit
+NUCLEOTIDE_CODES = np.full(256, 4, dtype=np.uint8)  # 4 for gaps and any non-ACGT character
+for nuc_code, nuc in enumerate("ACGT"):
+	NUCLEOTIDE_CODES[ord(nuc)] = NUCLEOTIDE_CODES[ord(nuc.lower())] = nuc_code
+SUBS_PAIRS = ["AC", "AG", "AT", "CG", "CT", "GT"]
+PACK_BLOCK_ROWS = 64  # sequences that are compared to a sequence at once, see infer_packed_substitution_counts
+
+
+def pack_bit_plane(bits):
+	"""
+	:param bits: boolean array of shape (ntaxa, nchars)
+	:return: uint64 array of shape (ntaxa, ceil(nchars/64)), 64 sites per word, padding bits are 0
+	"""
+	nwords = -(-bits.shape[1] // 64)
+	packed = np.zeros((bits.shape[0], nwords * 8), dtype=np.uint8)
+	packed[:, :-(-bits.shape[1] // 8)] = np.packbits(bits, axis=1, bitorder="little")
+	return packed.view(np.uint64)
+
+
+def get_msa_chars(msa, rows=None):
+	"""
+	:param msa: bio.AlignIO format
+	:param rows: (optional) the rows to take, with repeats, e.g., of the full msa, see collapse_duplicate_sequences
+	:return: uint8 array of shape (ntaxa, nchars) with the ascii code of every character
+	"""
+	chars = np.frombuffer("".join([str(rec.seq) for rec in msa]).encode(), dtype=np.uint8)\
+		.reshape(len(msa), msa.get_alignment_length())
+	return chars if rows is None else chars[rows]
+
+
+def get_site_patterns(msa):
+	"""
+	:param msa: bio.AlignIO format
+	:return: the distinct columns of msa as a uint8 array of shape (ntaxa, npatterns) of ascii codes (case is kept,
+	as in calculate_bollback_multinomial), and the number of sites of every pattern
+	"""
+	patterns, counts = np.unique(get_msa_chars(msa).T, axis=0, return_counts=True)
+	return patterns.T, counts
+
+
+def pack_msa(msa):
+	"""
+	:param msa: bio.AlignIO format
+	:return: hi, lo, valid - three uint64 bit planes of shape (ntaxa, ceil(nchars/64)): the high and low bits of the
+	2-bit nucleotide codes and a mask of the sites that are A/C/G/T (case insensitive). gaps and any other character
+	are invalid and have zero hi and lo bits
+	"""
+	nchars = msa.get_alignment_length()
+	nwords = -(-nchars // 64)
+	hi, lo, valid = [np.zeros((len(msa), nwords), dtype=np.uint64) for _ in range(3)]
+	# a sequence at a time, so the per-site character and code arrays never exist for more than one sequence
+	for row, rec in enumerate(msa):
+		codes = NUCLEOTIDE_CODES[np.frombuffer(str(rec.seq).encode(), dtype=np.uint8)][None]
+		row_valid = codes < 4
+		hi[row] = pack_bit_plane(row_valid & (codes >> 1 == 1))[0]
+		lo[row] = pack_bit_plane(row_valid & (codes & 1 == 1))[0]
+		valid[row] = pack_bit_plane(row_valid)[0]
+	return hi, lo, valid
+
+
+def infer_packed_substitution_counts(packed_msa, nchars, i):
+	"""
+	bit-parallel version of infer_pairwise_substitution_matrix for sequence i against every sequence j > i
+	:param packed_msa: the output of pack_msa
+	:param nchars: the alignment length
+	:return: a dictionary of the substitution_count_dictionary keys to int arrays with a value per j > i,
+	and an array of the pairwise alignment lengths (sites where both are nucleotides)
+	"""
+	hi, lo, valid = packed_msa
+	# PACK_BLOCK_ROWS sequences j at a time, so the temporary bit planes of the numpy kernel are bounded by the block
+	# and not by the msa
+	blocks_counts = [kernels.count_packed_substitutions(hi[i], lo[i], valid[i], hi[start:start + PACK_BLOCK_ROWS],
+	                                                    lo[start:start + PACK_BLOCK_ROWS],
+	                                                    valid[start:start + PACK_BLOCK_ROWS], nchars)
+	                 for start in range(i + 1, len(hi), PACK_BLOCK_ROWS)]
+	counts = np.concatenate(blocks_counts, axis=1) if blocks_counts else \
+		np.zeros((len(kernels.PACKED_COUNTS), 0), dtype=np.int64)
+	substitution_count_dictionary = dict(zip(kernels.PACKED_COUNTS, counts))
+	return substitution_count_dictionary, substitution_count_dictionary.pop("pa_length")
+
+
+def compute_pairwise_distances(msa):
+	"""
+	JC69-corrected pairwise distances, from the same substitution counts as calculate_substitution_rates
+	:param msa: bio.AlignIO format
+	:return: a symmetric (ntaxa, ntaxa) distance matrix. pairs without shared nucleotide sites or with saturated
+	p-distances get the largest distance
+	"""
+	MAX_DISTANCE = 5.0
+	packed_msa = pack_msa(msa)
+	nchars = msa.get_alignment_length()
+	distances = np.zeros((len(msa), len(msa)))
+	for i in range(0, len(msa)-1):
+		substitution_count_dictionary, pa_length = infer_packed_substitution_counts(packed_msa, nchars, i)
+		mismatches = sum([substitution_count_dictionary[pair] for pair in ["AC", "AG", "AT", "CG", "CT", "GT"]])
+		p_distances = mismatches / np.maximum(pa_length, 1)
+		with np.errstate(divide="ignore", invalid="ignore"):
+			jc_distances = -0.75 * np.log(1 - 4 * p_distances / 3)
+		jc_distances[(pa_length == 0) | ~(jc_distances < MAX_DISTANCE)] = MAX_DISTANCE
+		distances[i, i+1:] = distances[i+1:, i] = jc_distances
+	return distances
+
+
+def compute_base_frequencies(msa, weights=None):
 	freqs = []
 	seqs_msa = list(msa)
-	allchars = "".join([rec._seq._data for rec in seqs_msa])
+	if weights is None:
+		weights = [1] * len(seqs_msa)
 
 	for nuc in "ACGT":
-		freqs.append(len(re.findall(nuc, allchars, re.I)))
+		freqs.append(sum([w*len(re.findall(nuc, rec._seq._data, re.I)) for rec, w in zip(seqs_msa, weights)]))
 	freqs = {"freq_" + nuc : freq / sum(freqs) for nuc, freq in zip("ACGT", freqs)}
 	return freqs
 
 
-def calculate_substitution_rates(msa):
-	seqs_msa = list(msa)
-	transition_rates = []
-	transversion_rates = []
+def calculate_substitution_rates(msa, weights=None):
+	"""
+	same as applying compute_pairwise_substitution_rates to all the pairs of sequences, computed over 2-bit packed
+	sequences (see pack_msa) one sequence vs. all the following ones at a time
+	:param weights: (optional) the multiplicity of every sequence, see collapse_duplicate_sequences. a pair of
+	sequences counts as w1*w2 pairs, and every sequence adds w*(w-1)/2 pairs of identical copies
+	"""
+	MATCH_SCORE = 1
+	MISMATCH_SCORE = -1
+	GAP_SCORE = -1
+
+	packed_msa = pack_msa(msa)
+	nchars = msa.get_alignment_length()
+	weights = np.ones(len(msa), dtype=np.int64) if weights is None else np.array(weights, dtype=np.int64)
+	# the weighted sums of the rates are accumulated pair after pair, by the order of the pairs, as the sum of the
+	# list of the rates of all the pairs, without keeping the list
+	transition_sum = transversion_sum = 0
+	n_pairs = 0
 	sop_score = 0
 	ac_cnt = ag_cnt = at_cnt = cg_cnt = ct_cnt = gt_cnt = 0
-	for i in range(0, len(seqs_msa)-1):
-		for j in range(i+1,len(seqs_msa)):
-			seq1 = seqs_msa[i]._seq._data
-			seq2 = seqs_msa[j]._seq._data
-			transition_rate, transversion_rate, pair_sop, ac, ag, at, cg, ct, gt = compute_pairwise_substitution_rates(seq1, seq2)
-			transition_rates.append(transition_rate)
-			transversion_rates.append(transversion_rate)
-			sop_score += pair_sop
-			ac_cnt, ag_cnt, at_cnt, cg_cnt, ct_cnt, gt_cnt = \
-				ac_cnt + ac, ag_cnt + ag, at_cnt + at, cg_cnt + cg, ct_cnt + ct, gt_cnt + gt
+	for i in range(0, len(msa)):
+		# identical copies: no substitutions and no gaps vs. nucleotides, every nucleotide is a match
+		identical_pairs = int(weights[i] * (weights[i] - 1) // 2)
+		if identical_pairs > 0:
+			n_pairs += identical_pairs
+			sop_score += identical_pairs * int(kernels.count_set_bits(packed_msa[2][i:i+1])[0]) * MATCH_SCORE
+		if i == len(msa) - 1:
+			break
+
+		pair_weights = weights[i] * weights[i+1:]
+		substitution_count_dictionary, pa_length = infer_packed_substitution_counts(packed_msa, nchars, i)
+		transitions = substitution_count_dictionary["AG"] + substitution_count_dictionary["CT"]
+		transversions = substitution_count_dictionary["AC"] + substitution_count_dictionary["AT"] + \
+		                substitution_count_dictionary["CG"] + substitution_count_dictionary["GT"]
+		matches = substitution_count_dictionary["AA"] + substitution_count_dictionary["CC"] + \
+		          substitution_count_dictionary["GG"] + substitution_count_dictionary["TT"]
+		aligned = pa_length != 0
+		safe_pa_length = np.where(aligned, pa_length, 1)
+		pair_weights_lst = pair_weights.tolist()
+		transition_sum = sum([rate*w for rate, w in zip(np.where(aligned, transitions / safe_pa_length, 0).tolist(),
+		                                                pair_weights_lst)], transition_sum)
+		transversion_sum = sum([rate*w for rate, w in zip(np.where(aligned, transversions / safe_pa_length, 0).tolist(),
+		                                                  pair_weights_lst)], transversion_sum)
+		n_pairs += sum(pair_weights_lst)
+		sop_score += int(np.sum((np.where(aligned, matches*MATCH_SCORE + (transitions + transversions +
+		                                  substitution_count_dictionary["1s"])*MISMATCH_SCORE, 0) +
+		                         substitution_count_dictionary["1s"]*GAP_SCORE) * pair_weights))
+		ac_cnt, ag_cnt, at_cnt, cg_cnt, ct_cnt, gt_cnt = [cnt + int(np.sum(substitution_count_dictionary[pair] * pair_weights))
+		                                                  for cnt, pair in zip([ac_cnt, ag_cnt, at_cnt, cg_cnt, ct_cnt, gt_cnt],
+		                                                                       ["AC", "AG", "AT", "CG", "CT", "GT"])]
 
 	subs_sum = sum([ac_cnt, ag_cnt, at_cnt, cg_cnt, ct_cnt, gt_cnt])
-	return {"transition_avg": get_avg(transition_rates),
-			"transversion_avg": get_avg(transversion_rates),
+	return {"transition_avg": transition_sum/n_pairs,
+			"transversion_avg": transversion_sum/n_pairs,
 			"sop_score": sop_score},\
 		   {c: x/subs_sum if subs_sum != 0 else 0 for c,x in
 			zip(["ac_subs", "ag_subs", "at_subs", 'cg_subs', 'ct_subs', 'gt_subs'],
@@ -168,6 +329,38 @@ def remove_nonACTGU_sites(msa):
 	return new_msa
 
 
+def collapse_duplicate_sequences(msa):
+	"""
+	:param msa: bio.AlignIO format
+	:return: an msa with the first copy of every distinct sequence (sequences must be identical, including case),
+	a dictionary of the kept sequences names to the names of their removed copies, and the row of every sequence of
+	msa in the collapsed msa (chars[rows] are the characters of msa, see get_msa_chars)
+	"""
+	unique_records = []
+	duplicates = {}
+	representatives = {}
+	rows = []
+	for rec in msa:
+		seq = str(rec.seq)
+		if seq in representatives:
+			duplicates[unique_records[representatives[seq]].id].append(rec.id)
+		else:
+			representatives[seq] = len(unique_records)
+			duplicates[rec.id] = []
+			unique_records.append(rec)
+		rows.append(representatives[seq])
+	return AlignIO.MultipleSeqAlignment(unique_records), duplicates, np.array(rows, dtype=np.int64)
+
+
+def get_multiplicities(rows, nseqs):
+	"""
+	:param rows: see collapse_duplicate_sequences
+	:param nseqs: the number of sequences of the collapsed msa
+	:return: an array with the number of copies of every sequence of the collapsed msa
+	"""
+	return np.bincount(rows, minlength=nseqs)
+
+
 def reduce_msa_to_seqs_by_name(msa, keep_names_lst):
 	new_msa = []
 	all_names = [rec.id for rec in list(msa)]
@@ -177,3 +370,120 @@ def reduce_msa_to_seqs_by_name(msa, keep_names_lst):
 	new_msa = remove_nonACTGU_sites(AlignIO.MultipleSeqAlignment(new_msa))
 	return new_msa
 
+
+
+################################ site patterns features ################################
+# the msa features above, computed from the distinct site patterns (see get_site_patterns) for several weightings of
+# the patterns at once. site_weights is an array of shape (nreplicates, npatterns) with the number of sites of every
+# pattern in every replicate (e.g., bootstrap replicates); row_weights is the multiplicity of every sequence (see
+# get_multiplicities)
+
+def get_patterns_fully_conserved(patterns):
+	"""
+	:return: boolean array, True for fully conserved patterns (see get_columns_fully_conserved)
+	"""
+	return get_columns_fully_conserved(patterns)
+
+
+def calculate_patterns_entropy(patterns):
+	"""
+	:return: the entropy of every pattern (see calculate_columns_entropy)
+	"""
+	return calculate_columns_entropy(patterns)
+
+
+def count_patterns_nucleotides(codes, row_weights):
+	"""
+	:return: array of shape (4, npatterns) of the weighted A, C, G, T counts of every pattern
+	"""
+	return np.stack([((codes == nuc_code) * row_weights[:, None]).sum(axis=0) for nuc_code in range(4)])
+
+
+def calculate_patterns_bollback_multinomial(site_weights):
+	"""
+	:return: arrays of the calculate_bollback_multinomial values for every replicate
+	"""
+	msa_lengths = site_weights.sum(axis=1)
+	with np.errstate(divide="ignore", invalid="ignore"):
+		multinomial = np.where(site_weights > 0, site_weights * np.log(site_weights), 0).sum(axis=1)
+	multinomial -= msa_lengths * np.log(msa_lengths)
+	n_unique_sites = (site_weights > 0).sum(axis=1)
+	return multinomial, n_unique_sites, n_unique_sites / msa_lengths
+
+
+def compute_patterns_base_frequencies(codes, site_weights, row_weights):
+	"""
+	:return: a dictionary of the compute_base_frequencies keys to arrays with a value per replicate
+	"""
+	nuc_counts = site_weights @ count_patterns_nucleotides(codes, row_weights).T
+	return {"freq_" + nuc: nuc_counts[:, i] / nuc_counts.sum(axis=1) for i, nuc in enumerate("ACGT")}
+
+
+def calculate_patterns_substitution_rates(codes, site_weights, row_weights):
+	"""
+	:return: the two dictionaries of calculate_substitution_rates, with arrays of a value per replicate
+	"""
+	MATCH_SCORE = 1
+	MISMATCH_SCORE = -1
+	GAP_SCORE = -1
+
+	site_weights = site_weights.T.astype(float)
+	row_weights = np.asarray(row_weights, dtype=float)
+	valid = codes < 4
+	hi, lo = (codes >> 1) & 1, codes & 1
+	transition_sum = transversion_sum = sop_score = 0
+	n_pairs = 0
+	subs_cnts = dict.fromkeys(SUBS_PAIRS, 0)
+	for i in range(0, len(codes)):
+		# identical copies: no substitutions and no gaps vs. nucleotides, every nucleotide is a match
+		identical_pairs = row_weights[i] * (row_weights[i] - 1) / 2
+		n_pairs += identical_pairs
+		sop_score = sop_score + identical_pairs * (valid[i] @ site_weights) * MATCH_SCORE
+
+		pair_weights = (row_weights[i] * row_weights[i+1:])[:, None]
+		n_pairs += pair_weights.sum()
+		both_nucs = valid[i] & valid[i+1:]
+		hi_diff, lo_diff = (hi[i] != hi[i+1:]) & both_nucs, (lo[i] != lo[i+1:]) & both_nucs
+		transitions_ind = hi_diff & ~lo_diff
+		transversions_ind = lo_diff
+		pair_subs = {"AG": (transitions_ind & (lo[i] == 0)) @ site_weights,
+		             "CT": (transitions_ind & (lo[i] == 1)) @ site_weights,
+		             "AC": (transversions_ind & ~hi_diff & (hi[i] == 0)) @ site_weights,
+		             "GT": (transversions_ind & ~hi_diff & (hi[i] == 1)) @ site_weights,
+		             "AT": (transversions_ind & hi_diff & (hi[i] == lo[i])) @ site_weights,
+		             "CG": (transversions_ind & hi_diff & (hi[i] != lo[i])) @ site_weights}
+		pa_length = both_nucs @ site_weights
+		one_gap = (valid[i] ^ valid[i+1:]) @ site_weights
+		transitions = pair_subs["AG"] + pair_subs["CT"]
+		transversions = pair_subs["AC"] + pair_subs["AT"] + pair_subs["CG"] + pair_subs["GT"]
+		matches = pa_length - transitions - transversions
+
+		aligned = pa_length != 0
+		safe_pa_length = np.where(aligned, pa_length, 1)
+		transition_sum = transition_sum + (pair_weights * np.where(aligned, transitions / safe_pa_length, 0)).sum(axis=0)
+		transversion_sum = transversion_sum + (pair_weights * np.where(aligned, transversions / safe_pa_length, 0)).sum(axis=0)
+		sop_score = sop_score + (pair_weights * (np.where(aligned, matches*MATCH_SCORE + (transitions + transversions +
+		                                                  one_gap)*MISMATCH_SCORE, 0) + one_gap*GAP_SCORE)).sum(axis=0)
+		for pair in SUBS_PAIRS:
+			subs_cnts[pair] = subs_cnts[pair] + (pair_weights * pair_subs[pair]).sum(axis=0)
+
+	subs_sum = sum(subs_cnts.values())
+	safe_subs_sum = np.where(subs_sum != 0, subs_sum, 1)
+	return {"transition_avg": transition_sum / n_pairs,
+			"transversion_avg": transversion_sum / n_pairs,
+			"sop_score": sop_score},\
+		   {pair.lower() + "_subs": np.where(subs_sum != 0, subs_cnts[pair] / safe_subs_sum, 0) for pair in SUBS_PAIRS}
+
+
+def reduce_patterns_to_rows(patterns, site_weights, rows):
+	"""
+	the site patterns version of reduce_msa_to_seqs_by_name
+	:param rows: indexes of the sequences to keep
+	:return: the distinct patterns of the kept sequences, without patterns that are just gaps, and their weights
+	"""
+	reduced_patterns = patterns[rows]
+	has_nucs = np.isin(reduced_patterns, np.frombuffer(b"ACGTUacgtu", dtype=np.uint8)).any(axis=0)
+	reduced_patterns, inverse = np.unique(reduced_patterns[:, has_nucs].T, axis=0, return_inverse=True)
+	reduced_site_weights = np.zeros((len(reduced_patterns), site_weights.shape[0]), dtype=site_weights.dtype)
+	np.add.at(reduced_site_weights, inverse.reshape(-1), site_weights[:, has_nucs].T)
+	return reduced_patterns.T, reduced_site_weights.T
@@ -0,0 +1,128 @@
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+from definitions import *
+
+
+# a range of columns, 1-based and inclusive: "1-500", "3-1200\3" (every third column), "7", "501-." (to the end)
+RANGE_PATTERN = re.compile(r"^(\d+)(?:-(\d+|\.))?(?:\\(\d+))?$")
+NEXUS_CHARSET_PATTERN = re.compile(r"charset\s+('[^']+'|\S+?)\s*=\s*([^;]+);", re.I)
+RAXML_PARTITION_PATTERN = re.compile(r"^\s*[^,=]+,\s*(\S+)\s*=\s*(.+?)\s*$")
+
+
+def parse_ranges(ranges_string):
+	"""
+	:param ranges_string: column ranges separated by commas or spaces, e.g., "1-500, 1001-1200\3"
+	:return: a list of slices of the (0-based) alignment columns
+	"""
+	ranges_string = re.sub(r"\s*([-\\])\s*", r"\1", ranges_string.strip())
+	slices = []
+	for range_string in re.split(r"[,\s]+", ranges_string):
+		match = RANGE_PATTERN.match(range_string)
+		if not match:
+			raise ValueError("Invalid range of columns in the partitions file: " + range_string)
+		start, end, step = match.groups()
+		end = start if end is None else (None if end == "." else end)
+		slices.append(slice(int(start) - 1, None if end is None else int(end), int(step or 1)))
+	return slices
+
+
+def parse_partitions_file(partitions_filepath):
+	"""
+	:param partitions_filepath: a NEXUS file with a charset per partition (e.g., "charset gene1 = 1-500;"), or a
+	RAxML-style partition file with a line per partition (e.g., "DNA, gene1 = 1-500")
+	:return: a list of (name, slices of the columns) of the partitions, by the order of the file
+	"""
+	with open(partitions_filepath) as fpr:
+		content = fpr.read()
+
+	charsets = NEXUS_CHARSET_PATTERN.findall(content)
+	if charsets:
+		partitions_lst = [(name.strip("'"), ranges_string.strip()) for name, ranges_string in charsets]
+	else:
+		partitions_lst = []
+		for line in content.splitlines():
+			if not line.strip() or line.strip().startswith("#"):
+				continue
+			match = RAXML_PARTITION_PATTERN.match(line)
+			if not match:
+				raise ValueError("Invalid line in the partitions file: " + line)
+			partitions_lst.append(match.groups())
+
+	if not partitions_lst:
+		raise ValueError("No partitions were found in " + partitions_filepath)
+	safe_names = [get_safe_partition_name(name) for name, _ in partitions_lst]
+	if len(set(safe_names)) < len(safe_names):
+		raise ValueError("The partitions names must be distinct, also with characters other than letters, digits, "
+		                 "'_', '.' and '-' replaced by '_': " + ", ".join(safe_names))
+	return [(name, parse_ranges(ranges_string)) for name, ranges_string in partitions_lst]
+
+
+def get_safe_partition_name(name):
+	"""
+	:return: the name with the characters that are not safe in a path, a PhyML command line or a RAxML partition file
+	replaced by "_"
+	"""
+	return re.sub(r"[^\w.-]", "_", name)
+
+
+def format_ranges(slices, nchars):
+	"""
+	:return: the ranges string of the slices (see parse_ranges), with explicit ends
+	"""
+	ranges = []
+	for col_slice in slices:
+		start, stop = col_slice.start + 1, nchars if col_slice.stop is None else col_slice.stop
+		range_string = str(start) if start == stop else "{}-{}".format(start, stop)
+		ranges.append(range_string + ("\\" + str(col_slice.step) if col_slice.step != 1 else ""))
+	return ", ".join(ranges)
+
+
+def get_partition_columns(slices, nchars):
+	"""
+	:param slices: see parse_ranges
+	:param nchars: the alignment length
+	:return: int array of the columns of the partition, by the order of the slices
+	"""
+	for col_slice in slices:
+		if col_slice.start < 0 or (col_slice.stop is not None and col_slice.stop <= col_slice.start):
+			raise ValueError("Invalid range of columns in the partitions file: {}-{}".format(col_slice.start + 1,
+			                                                                               col_slice.stop))
+		if col_slice.start >= nchars or (col_slice.stop or 0) > nchars:
+			raise ValueError("The partitions exceed the alignment length ({})".format(nchars))
+	all_columns = np.arange(nchars)
+	return np.concatenate([all_columns[col_slice] for col_slice in slices])
+
+
+def get_partition_msa(seq_ids, msa_chars, columns):
+	"""
+	:param seq_ids: the names of the sequences
+	:param msa_chars: the characters of the msa, see msa_functions.get_msa_chars. shared by all the partitions
+	:param columns: see get_partition_columns
+	:return: the columns of the partition, in bio.AlignIO format
+	"""
+	partition_chars = np.ascontiguousarray(msa_chars[:, columns])
+	return AlignIO.MultipleSeqAlignment([SeqRecord(Seq(row.tobytes().decode()), id=seq_id)
+	                                     for seq_id, row in zip(seq_ids, partition_chars)])
+
+
+def get_partition_msa_filepath(msa_filepath, partition_i, partition_name):
+	"""
+	:param partition_i: the 1-based index of the partition in the partitions file
+	:return: the path of the PHYLIP file of the partition, with the safe name of the partition (see
+	get_safe_partition_name)
+	"""
+	return "{}_partition_{}_{}.phy".format(msa_filepath, partition_i, get_safe_partition_name(partition_name))
+
+
+def write_partition_models_file(partitions_lst, selected_models, nchars, models_filepath):
+	"""
+	writes the selected models as a RAxML-style partition file, e.g., "GTR+I+G, gene1 = 1-500". the names are
+	written safe (see get_safe_partition_name), e.g., "gene_1" for 'gene 1'
+	:param partitions_lst: see parse_partitions_file
+	:param selected_models: the selected model of every partition, by the order of partitions_lst
+	:param nchars: the alignment length, for ranges to the end of the alignment
+	"""
+	with open(models_filepath, "w") as fpw:
+		for (name, slices), model in zip(partitions_lst, selected_models):
+			fpw.write("{}, {} = {}\n".format(model, get_safe_partition_name(name), format_ranges(slices, nchars)))
@@ -1,5 +1,6 @@
 from definitions import *
-from utils import is_file_empty
+from utils import is_file_empty, get_temp_suffix
+import kernels
 
 
 ############################### additional parameters ###############################
@@ -58,15 +59,20 @@ def run_phyml(msa_filepath, full_model, topology="ml", tree_file=None, run_id=No
 	:return: the stats/tree output filepath (i.e., msa_filepath+"_phyml_stats/tree_"+run_id+".txt"
 	"""
 	run_id = full_model if run_id is None else run_id
-	phyml_exec_line = create_phyml_exec_line_full_model(msa_filepath, full_model, topology, tree_file, run_id)
 	output_filename = msa_filepath + "_phyml_{}_" + run_id + ".txt"
-
-	stats_file, tree_file = output_filename.format("stats"), output_filename.format("tree")
+	stats_file, out_tree_file = output_filename.format("stats"), output_filename.format("tree")
 
 	if is_file_empty(stats_file):
-		os.system(phyml_exec_line)
+		# phyml writes its outputs gradually, so run it under a private run_id and move the complete outputs into
+		# place. the stats file is moved last since its existence marks the run as done for other workers
+		temp_run_id = run_id + get_temp_suffix()
+		os.system(create_phyml_exec_line_full_model(msa_filepath, full_model, topology, tree_file, temp_run_id))
+		temp_filename = msa_filepath + "_phyml_{}_" + temp_run_id + ".txt"
+		for output_type, output_file in [("tree", out_tree_file), ("stats", stats_file)]:
+			if os.path.exists(temp_filename.format(output_type)):
+				os.replace(temp_filename.format(output_type), output_file)
 
-	return stats_file, tree_file
+	return stats_file, out_tree_file
 
 
 def parse_phyml_stats_file(phyml_stats_filepath):
@@ -138,14 +144,7 @@ def parse_phyml_stats_file(phyml_stats_filepath):
 			[None, None, None, freq_GT]]
 	matrix = read_matrix(phyml_content)
 
-	i = 0
-	j = 1
-	while (matrix[i][j] == 0) and (i < 4): # get to the first rate that != 0
-		if j == 3:
-			i += 1
-			j = i+1
-		else:
-			j += 1
+	i, j = (int(x) for x in kernels.find_first_nonzero_rate(np.array(matrix))) # get to the first rate that != 0
 
 	# relevant mainly to GTR
 	res_dict["mu_rate"] = matrix[i][j]/float(nuc_freq[j]*subs[i][j])
@@ -0,0 +1,239 @@
+import traceback
+import zlib
+
+from definitions import *
+
+
+LEASES_DIRNAME = ".modelteller_leases"
+LEASE_TIMEOUT = 30 * 60  # seconds without a heartbeat after which a lease is considered abandoned
+# files that ModelTeller writes next to the alignments and that should not be claimed as inputs
+SHARD_OUTPUT_MARKERS = ["_phyml_", "features_with_models_rankings.csv", "audit_models_table.csv",
+                        "bootstrap_rank1_frequencies.csv", "partitions_models.txt", ".tmp_", "_unique.phy",
+                        "_fast_tree_"]
+# the generated PHYLIP files of the records of a multi-record file (see modelteller.process_alignments) and of the
+# partitions (see partitions.get_partition_msa_filepath), matched exactly so that inputs such as "gene_record.fas"
+# are still listed
+SHARD_OUTPUT_PATTERNS = [re.compile(r"_record\d+\.phy$"), re.compile(r"_partition_\d+_[\w.-]*\.phy$")]
+
+
+def get_worker_id():
+	return socket.gethostname() + "_" + str(os.getpid())
+
+
+def list_alignments(work_dir):
+	"""
+	:param work_dir: the shared directory that holds the alignments to process
+	:return: sorted list of alignment files in work_dir, outputs of previous runs excluded
+	"""
+	msa_files = []
+	with os.scandir(work_dir) as entries:  # the file types come with the listing, without a stat per file
+		for entry in entries:
+			if entry.name.startswith(".") or not entry.is_file():
+				continue
+			if any(marker in entry.name for marker in SHARD_OUTPUT_MARKERS) or \
+					any(pattern.search(entry.name) for pattern in SHARD_OUTPUT_PATTERNS):
+				continue
+			msa_files.append(entry.path)
+	return sorted(msa_files)
+
+
+def get_lease_filepaths(msa_filepath):
+	"""
+	:return: the lease, done and failed marker filepaths of an alignment in the work directory
+	"""
+	leases_dir = os.path.join(os.path.dirname(msa_filepath), LEASES_DIRNAME)
+	lease_prefix = os.path.join(leases_dir, os.path.basename(msa_filepath))
+	return lease_prefix + ".lease", lease_prefix + ".done", lease_prefix + ".failed"
+
+
+def list_leases(work_dir):
+	"""
+	reads the leases directory once, instead of checking the markers of every alignment
+	:return: two sets of alignment filenames - the leased ones, and the finished ones (done or failed)
+	"""
+	leased, finished = set(), set()
+	for filename in os.listdir(os.path.join(work_dir, LEASES_DIRNAME)):
+		msa_filename, extension = os.path.splitext(filename)
+		if extension == ".lease":
+			leased.add(msa_filename)
+		elif extension in [".done", ".failed"]:
+			finished.add(msa_filename)
+	return leased, finished
+
+
+def create_marker_file(filepath, content):
+	"""
+	:return: True if filepath was created by this call, False if it already exists.
+	O_EXCL creation is atomic on local filesystems and on NFSv3 and newer, so only one worker can succeed
+	"""
+	try:
+		fd = os.open(filepath, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+	except FileExistsError:
+		return False
+	with os.fdopen(fd, "w") as fpw:
+		fpw.write(content)
+	return True
+
+
+def is_lease_owner(lease_filepath, worker_id):
+	"""
+	:return: True if the lease exists and was created by worker_id
+	"""
+	try:
+		with open(lease_filepath) as fpr:
+			return fpr.read() == worker_id
+	except FileNotFoundError:
+		return False
+
+
+def release_lease(lease_filepath, worker_id):
+	"""
+	removes the lease only if worker_id owns it, the lease may have been reclaimed by another worker
+	"""
+	if is_lease_owner(lease_filepath, worker_id):
+		try:
+			os.remove(lease_filepath)
+		except FileNotFoundError:
+			pass
+
+
+def reclaim_expired_lease(lease_filepath, worker_id, lease_timeout):
+	"""
+	removes the lease if its owner stopped sending heartbeats for more than lease_timeout seconds
+	:return: True if the lease was removed by this worker
+	"""
+	try:
+		if time.time() - os.path.getmtime(lease_filepath) <= lease_timeout:
+			return False
+		# rename is atomic - if several workers try to reclaim the same lease only one of them succeeds
+		expired_filepath = lease_filepath + ".expired_" + worker_id
+		os.rename(lease_filepath, expired_filepath)
+	except FileNotFoundError:
+		return False
+
+	# another worker may have reclaimed and re-acquired the lease between the age check and the rename. restore it
+	# with link, that fails rather than overwrite a lease that was created in the meantime
+	if time.time() - os.path.getmtime(expired_filepath) <= lease_timeout:
+		try:
+			os.link(expired_filepath, lease_filepath)
+		except FileExistsError:
+			pass
+		os.remove(expired_filepath)
+		return False
+	os.remove(expired_filepath)
+	return True
+
+
+def acquire_lease(msa_filepath, worker_id, lease_timeout):
+	"""
+	the caller is expected to skip processed alignments (see list_leases), they are checked again only once leased
+	:return: the lease filepath if this worker now owns the alignment, None if it is owned or already processed
+	"""
+	lease_filepath, done_filepath, failed_filepath = get_lease_filepaths(msa_filepath)
+	if not create_marker_file(lease_filepath, worker_id):
+		if not reclaim_expired_lease(lease_filepath, worker_id, lease_timeout) or \
+				not create_marker_file(lease_filepath, worker_id):
+			return None
+
+	# the previous owner might have finished between the listing of the leases and the lease creation
+	if os.path.exists(done_filepath) or os.path.exists(failed_filepath):
+		release_lease(lease_filepath, worker_id)
+		return None
+	return lease_filepath
+
+
+def start_heartbeat(lease_filepath, worker_id, lease_timeout):
+	"""
+	touches the lease file periodically in a background thread so other workers know its owner is alive
+	:return: two threading.Events - set the first to stop the heartbeat. the second is set by the heartbeat if the
+	lease was removed or taken by another worker (e.g., reclaimed after this worker stalled)
+	"""
+	stop_event = threading.Event()
+	lease_lost = threading.Event()
+
+	def beat():
+		while not stop_event.wait(lease_timeout / 3):
+			try:
+				if not is_lease_owner(lease_filepath, worker_id):
+					raise FileNotFoundError(lease_filepath)
+				os.utime(lease_filepath)
+			except FileNotFoundError:
+				lease_lost.set()
+				return
+
+	threading.Thread(target=beat, daemon=True).start()
+	return stop_event, lease_lost
+
+
+def claim_next_alignment(work_dir, worker_id, lease_timeout, finished=None):
+	"""
+	lists work_dir and the leases directory once per claim. the alignments are scanned from an offset of the worker,
+	so that concurrent workers do not all compete for the first ones, and the leased alignments are scanned last,
+	only to reclaim expired leases
+	:param finished: a set of the alignment filepaths that this worker knows are processed, which are not scanned.
+	the alignments that are found to be processed are added to it
+	:return: (msa_filepath, lease_filepath) of an unprocessed alignment that this worker managed to lease,
+	(None, None) if no alignment is available
+	"""
+	if finished is None:
+		finished = set()
+	msa_filepaths = [msa_filepath for msa_filepath in list_alignments(work_dir) if msa_filepath not in finished]
+	leased, finished_filenames = list_leases(work_dir)
+	unleased_filepaths, leased_filepaths = [], []
+	if msa_filepaths:
+		offset = zlib.crc32(worker_id.encode()) % len(msa_filepaths)
+		for msa_filepath in msa_filepaths[offset:] + msa_filepaths[:offset]:
+			msa_filename = os.path.basename(msa_filepath)
+			if msa_filename in finished_filenames:
+				finished.add(msa_filepath)
+			else:
+				(leased_filepaths if msa_filename in leased else unleased_filepaths).append(msa_filepath)
+
+	for msa_filepath in unleased_filepaths + leased_filepaths:
+		lease_filepath = acquire_lease(msa_filepath, worker_id, lease_timeout)
+		if lease_filepath:
+			return msa_filepath, lease_filepath
+	return None, None
+
+
+def run_worker(work_dir, process_alignment, logger, lease_timeout=LEASE_TIMEOUT):
+	"""
+	processes alignments of work_dir until none is left. any number of workers, on any number of hosts that mount
+	work_dir, may run concurrently - each alignment is leased by a single worker at a time, and leases of workers
+	that died are reclaimed after lease_timeout seconds
+	:param work_dir: a directory that holds the alignments, on a filesystem shared by all workers
+	:param process_alignment: a function that gets an alignment filepath and runs ModelTeller on it
+	:param logger: the logger of the calling script
+	:param lease_timeout: seconds without a heartbeat after which a lease is considered abandoned
+	:return: number of alignments processed by this worker
+	"""
+	os.makedirs(os.path.join(work_dir, LEASES_DIRNAME), exist_ok=True)
+	worker_id = get_worker_id()
+	processed_cnt = 0
+	finished = set()  # the alignments that this worker knows are processed, by it or by others
+	while True:
+		msa_filepath, lease_filepath = claim_next_alignment(work_dir, worker_id, lease_timeout, finished)
+		if msa_filepath is None:
+			break
+		finished.add(msa_filepath)  # when the lease is lost, the alignment is processed by its new owner
+		logger.info("Worker " + worker_id + " processing: " + msa_filepath)
+		_, done_filepath, failed_filepath = get_lease_filepaths(msa_filepath)
+		stop_heartbeat, lease_lost = start_heartbeat(lease_filepath, worker_id, lease_timeout)
+		try:
+			process_alignment(msa_filepath)
+			if lease_lost.is_set() or not is_lease_owner(lease_filepath, worker_id):
+				# the alignment was reclaimed by another worker, which owns its markers now
+				logger.warning("Worker " + worker_id + " lost the lease of " + msa_filepath + ", not marking it done")
+				continue
+			create_marker_file(done_filepath, worker_id)
+		except Exception:
+			logger.error("Failed processing " + msa_filepath + ":\n" + traceback.format_exc())
+			if not lease_lost.is_set() and is_lease_owner(lease_filepath, worker_id):
+				create_marker_file(failed_filepath, worker_id + "\n" + traceback.format_exc())
+		finally:
+			stop_heartbeat.set()
+			release_lease(lease_filepath, worker_id)
+		processed_cnt += 1
+
+	logger.info("Worker " + worker_id + " is done, no unprocessed alignments are left. Processed: " + str(processed_cnt))
+	return processed_cnt
@@ -0,0 +1,77 @@
+import os
+import random
+import sys
+
+import pytest
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PACKAGE_DIR)
+
+from definitions import *
+import compute_features
+import msa_functions
+
+
+def get_msa_with_duplicates(seed, nunique=8, nduplicates=10, nchars=120):
+	"""
+	:return: an msa of distinct gappy sequences and copies of them, in a random order
+	"""
+	rng = np.random.default_rng(seed)
+	chars = rng.choice(np.frombuffer(b"ACGTACGTacgt-N", dtype=np.uint8), size=(nunique, nchars))
+	for _ in range(nunique * nchars // 8):  # runs of gaps, as in alignments
+		row, col = rng.integers(nunique), rng.integers(nchars)
+		chars[row, col:col + rng.integers(1, 8)] = ord("-")
+	rows = rng.permutation(np.concatenate([np.arange(nunique), rng.integers(0, nunique, nduplicates)]))
+	return AlignIO.MultipleSeqAlignment([SeqRecord(Seq(chars[row].tobytes().decode()), id="seq" + str(i))
+	                                     for i, row in enumerate(rows)])
+
+
+def assert_features_equal(features, expected):
+	assert features.keys() == expected.keys()
+	for k in expected:
+		assert features[k] == pytest.approx(expected[k], rel=1e-12), k
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_collapsed_msa_features(seed):
+	msa = get_msa_with_duplicates(seed)
+	unique_msa, duplicates, rows = msa_functions.collapse_duplicate_sequences(msa)
+	assert len(unique_msa) < len(msa)
+	assert_features_equal(compute_features.calculate_alignment_features(unique_msa, rows=rows),
+	                      compute_features.calculate_alignment_features(msa))
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_collapsed_reduced_msa_features(seed):
+	msa = get_msa_with_duplicates(seed)
+	unique_msa, duplicates, rows = msa_functions.collapse_duplicate_sequences(msa)
+	random.seed(seed)  # of ete3 populate
+	tree = Tree()
+	tree.populate(len(msa), names_library=[rec.id for rec in msa], random_branches=True)
+	ingroup_names, _ = compute_features.get_reduced_msa_sequences(tree)
+	unique_ingroup_names, reduced_rows = compute_features.get_reduced_msa_sequences(tree, duplicates)
+	assert_features_equal(compute_features.calculate_alignment_features(
+		msa_functions.reduce_msa_to_seqs_by_name(unique_msa, unique_ingroup_names), reduced=True, rows=reduced_rows),
+		compute_features.calculate_alignment_features(msa_functions.reduce_msa_to_seqs_by_name(msa, ingroup_names),
+		                                              reduced=True))
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_patterns_features(seed):
+	msa = get_msa_with_duplicates(seed)
+	patterns, counts = msa_functions.get_site_patterns(msa)
+	patterns_features = compute_features.calculate_patterns_alignment_features(patterns, counts[None])
+	assert_features_equal({k: patterns_features[k][0] for k in patterns_features},
+	                      compute_features.calculate_alignment_features(msa))
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_collapsed_patterns_features(seed):
+	msa = get_msa_with_duplicates(seed)
+	unique_msa, _, rows = msa_functions.collapse_duplicate_sequences(msa)
+	patterns, counts = msa_functions.get_site_patterns(unique_msa)
+	patterns_features = compute_features.calculate_patterns_alignment_features(patterns, counts[None], rows=rows)
+	assert_features_equal({k: patterns_features[k][0] for k in patterns_features},
+	                      compute_features.calculate_alignment_features(msa))
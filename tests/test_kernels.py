@@ -0,0 +1,168 @@
+import os
+import random
+import sys
+
+import pytest
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PACKAGE_DIR)
+
+from definitions import *
+import compute_features
+import kernels
+import msa_functions
+import tree_functions
+
+
+EXAMPLE_MSA = os.path.join(PACKAGE_DIR, "example", "test_msa.phy")
+EXAMPLE_TREE = os.path.join(PACKAGE_DIR, "example", "test_tree.txt")
+requires_numba = pytest.mark.skipif("numba" not in kernels.BACKENDS, reason="numba is not installed")
+
+
+def get_gappy_chars(seed, ntaxa=30, nchars=200):
+	"""
+	:return: random characters with runs of gaps and ambiguous characters, in both cases
+	"""
+	rng = np.random.default_rng(seed)
+	chars = rng.choice(np.frombuffer(b"ACGTacgt", dtype=np.uint8), size=(ntaxa, nchars))
+	for _ in range(ntaxa * nchars // 10):
+		row, col = rng.integers(ntaxa), rng.integers(nchars)
+		chars[row:row + rng.integers(1, 6), col] = rng.choice(np.frombuffer(b"-N?n", dtype=np.uint8))
+	return chars
+
+
+def get_alignments():
+	"""
+	:return: the example msa and gappy msas, in bio.AlignIO format
+	"""
+	msas = [AlignIO.read(EXAMPLE_MSA, "phylip-relaxed")]
+	for seed in range(3):
+		msas.append(AlignIO.MultipleSeqAlignment([SeqRecord(Seq(row.tobytes().decode()), id="seq" + str(i))
+		                                          for i, row in enumerate(get_gappy_chars(seed))]))
+	return msas
+
+
+def get_alignments_chars():
+	return [msa_functions.get_msa_chars(msa) for msa in get_alignments()]
+
+
+def get_postorder_arrays(tree):
+	nodes = list(tree.traverse(strategy="postorder"))
+	nodes_indexes = {node: i for i, node in enumerate(nodes)}
+	children = np.array([[nodes_indexes[node.children[0]], nodes_indexes[node.children[1]]] if not node.is_leaf()
+	                     else [-1, -1] for node in nodes], dtype=np.int64)
+	return children, np.array([node.dist for node in nodes], dtype=float)
+
+
+def get_trees():
+	random.seed(1)  # of ete3 populate
+	trees = [Tree(EXAMPLE_TREE, format=1)]
+	for size in [3, 5, 100]:
+		tree = Tree()
+		tree.populate(size, random_branches=True)
+		trees.append(tree)
+	caterpillar = Tree()
+	for i in range(200):
+		caterpillar = caterpillar.add_child(name="t" + str(i), dist=0.1).up.add_child(dist=0.2)
+	caterpillar.add_child(name="last1", dist=0.3)
+	caterpillar.add_child(name="last2", dist=0.4)
+	trees.append(caterpillar.get_tree_root())
+	for tree in trees:
+		tree.resolve_polytomy()
+	return trees
+
+
+@pytest.fixture
+def restore_backend():
+	backend = kernels.current_backend
+	yield
+	kernels.set_backend(backend)
+
+
+################################ numpy kernels against the reference code ################################
+
+@pytest.mark.parametrize("chars", get_alignments_chars())
+def test_gapless_mask_matches_remove_gaps_from_sequence(chars):
+	mask = kernels.BACKENDS["numpy"]["get_gapless_mask"](chars)
+	for col in range(chars.shape[1]):
+		col_string = chars[:, col].tobytes().decode()
+		assert chars[mask[:, col], col].tobytes().decode() == msa_functions.remove_gaps_from_sequence(col_string)
+
+
+@pytest.mark.parametrize("chars", get_alignments_chars())
+def test_columns_entropy_matches_column_entropy(chars):
+	entropies = msa_functions.calculate_columns_entropy(chars)
+	for col in range(chars.shape[1]):
+		assert entropies[col] == pytest.approx(msa_functions.calculate_column_entropy(chars[:, col].tobytes().decode()))
+
+
+@pytest.mark.parametrize("tree", get_trees())
+def test_accumulate_postorder_matches_recursion(tree):
+	children, dists = get_postorder_arrays(tree)
+	subtree_blsum, heights = kernels.BACKENDS["numpy"]["accumulate_postorder"](children, dists)
+	root = len(children) - 1
+	assert subtree_blsum[root] == pytest.approx(sum(node.dist for node in tree.iter_descendants()))
+	assert heights[root] == pytest.approx(tree.get_farthest_leaf()[1])
+
+
+################################ numba kernels against the numpy kernels ################################
+
+@requires_numba
+@pytest.mark.parametrize("msa", get_alignments())
+def test_count_packed_substitutions(msa):
+	hi, lo, valid = msa_functions.pack_msa(msa)
+	for i in range(len(msa) - 1):
+		args = hi[i], lo[i], valid[i], hi[i + 1:], lo[i + 1:], valid[i + 1:], msa.get_alignment_length()
+		np.testing.assert_array_equal(kernels.BACKENDS["numba"]["count_packed_substitutions"](*args),
+		                              kernels.BACKENDS["numpy"]["count_packed_substitutions"](*args))
+
+
+@requires_numba
+@pytest.mark.parametrize("tree", get_trees())
+def test_accumulate_postorder(tree):
+	children, dists = get_postorder_arrays(tree)
+	for numba_values, numpy_values in zip(kernels.BACKENDS["numba"]["accumulate_postorder"](children, dists),
+	                                      kernels.BACKENDS["numpy"]["accumulate_postorder"](children, dists)):
+		np.testing.assert_allclose(numba_values, numpy_values)
+
+
+@requires_numba
+@pytest.mark.parametrize("seed", range(5))
+def test_find_first_nonzero_rate(seed):
+	rng = np.random.default_rng(seed)
+	for _ in range(50):
+		matrix = rng.random((4, 4)) * (rng.random((4, 4)) < 0.3)
+		matrix[3, 2] = matrix[2, 3] = 1  # at least one rate above the diagonal
+		assert tuple(kernels.BACKENDS["numba"]["find_first_nonzero_rate"](matrix)) == \
+		       tuple(kernels.BACKENDS["numpy"]["find_first_nonzero_rate"](matrix))
+
+
+@requires_numba
+@pytest.mark.parametrize("chars", get_alignments_chars())
+def test_get_gapless_mask(chars):
+	np.testing.assert_array_equal(kernels.BACKENDS["numba"]["get_gapless_mask"](chars),
+	                              kernels.BACKENDS["numpy"]["get_gapless_mask"](chars))
+
+
+@requires_numba
+@pytest.mark.parametrize("msa", get_alignments())
+def test_alignment_features(msa, restore_backend):
+	features = {}
+	for backend in ["numpy", "numba"]:
+		kernels.set_backend(backend)
+		features[backend] = compute_features.calculate_alignment_features(msa)
+	assert features["numba"].keys() == features["numpy"].keys()
+	for k in features["numpy"]:
+		assert features["numba"][k] == pytest.approx(features["numpy"][k]), k
+
+
+@requires_numba
+@pytest.mark.parametrize("tree", get_trees())
+def test_stemminess_indexes(tree, restore_backend):
+	indexes = {}
+	for backend in ["numpy", "numba"]:
+		kernels.set_backend(backend)
+		indexes[backend] = tree_functions.get_stemminess_indexes(tree)
+	assert indexes["numba"] == pytest.approx(indexes["numpy"])
@@ -0,0 +1,61 @@
+import gzip
+import os
+import sys
+
+import pytest
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PACKAGE_DIR)
+
+from definitions import *
+import modelteller
+
+
+def get_random_msa(seed, ntaxa, nchars):
+	rng = np.random.default_rng(seed)
+	chars = rng.choice(np.frombuffer(b"ACGT-", dtype=np.uint8), size=(ntaxa, nchars))
+	return AlignIO.MultipleSeqAlignment([SeqRecord(Seq(row.tobytes().decode()), id="seq" + str(i), description="")
+	                                     for i, row in enumerate(chars)])
+
+
+@pytest.mark.parametrize("aln_format", ["clustal", "fasta", "nexus", "phylip-relaxed", "stockholm"])
+@pytest.mark.parametrize("nchars", [100, 20000])  # the first alignment in the head of the file, and beyond it
+@pytest.mark.parametrize("compressed", [False, True])
+def test_detect_alignment_format(tmp_path, monkeypatch, aln_format, nchars, compressed):
+	msa = get_random_msa(nchars, 10, nchars)
+	msa_filepath = str(tmp_path / "msa")
+	with (gzip.open(msa_filepath, "wt") if compressed else open(msa_filepath, "w")) as fpw:
+		if aln_format == "nexus":  # the nexus writer requires an alphabet
+			fpw.write("#NEXUS\nbegin data;\ndimensions ntax={} nchar={};\nformat datatype=dna missing=? gap=-;\nmatrix\n"
+			          .format(len(msa), nchars) + "".join("{} {}\n".format(rec.id, rec.seq) for rec in msa) + ";\nend;\n")
+		else:
+			AlignIO.write(msa, fpw, aln_format)
+
+	read_sizes = []
+	open_alignment_file = modelteller.open_alignment_file
+
+	def open_counted_alignment_file(filepath):
+		fpr = open_alignment_file(filepath)
+		read_sizes.append(None)
+		read = fpr.read
+		fpr.read = lambda size=-1: read_sizes.append(size) or read(size)
+		return fpr
+
+	monkeypatch.setattr(modelteller, "open_alignment_file", open_counted_alignment_file)
+	detected_format = modelteller.detect_alignment_format(msa_filepath)
+	assert detected_format == aln_format
+	# the file is opened once, and only its head is read
+	assert read_sizes[0] is None and None not in read_sizes[1:]
+	assert all(0 <= size <= modelteller.FORMAT_DETECTION_CHARS for size in read_sizes[1:])
+	with (gzip.open(msa_filepath, "rt") if compressed else open(msa_filepath)) as fpr:
+		parsed_msa = AlignIO.read(fpr, detected_format)
+	assert [str(rec.seq) for rec in parsed_msa] == [str(rec.seq) for rec in msa]
+
+
+def test_detect_invalid_alignment_format(tmp_path):
+	msa_filepath = str(tmp_path / "msa.txt")
+	with open(msa_filepath, "w") as fpw:
+		fpw.write("not an alignment\n")
+	assert modelteller.detect_alignment_format(msa_filepath) is None
@@ -0,0 +1,79 @@
+import os
+import sys
+
+import pytest
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PACKAGE_DIR)
+
+from definitions import *
+from utils import get_avg
+import msa_functions
+
+
+EXAMPLE_MSA = os.path.join(PACKAGE_DIR, "example", "test_msa.phy")
+# upper and lower case nucleotides, gaps, N, U and IUPAC ambiguity codes
+ALIGNMENT_CHARS = np.frombuffer(b"ACGTACGTacgtacgt--NnUuRYKMSWBDHVryswkm?", dtype=np.uint8)
+
+
+def get_random_msa(seed, ntaxa=12, nchars=150):
+	rng = np.random.default_rng(seed)
+	chars = rng.choice(ALIGNMENT_CHARS, size=(ntaxa, nchars))
+	chars[1] = chars[0]  # a pair of identical sequences
+	return AlignIO.MultipleSeqAlignment([SeqRecord(Seq(row.tobytes().decode()), id="seq" + str(i))
+	                                     for i, row in enumerate(chars)])
+
+
+def get_alignments():
+	return [AlignIO.read(EXAMPLE_MSA, "phylip-relaxed")] + [get_random_msa(seed) for seed in range(4)]
+
+
+def calculate_pairwise_substitution_rates(msa):
+	"""
+	calculate_substitution_rates as the sum of compute_pairwise_substitution_rates over all the pairs of sequences
+	"""
+	seqs = [str(rec.seq) for rec in msa]
+	transition_rates, transversion_rates = [], []
+	sop_score = 0
+	subs_cnts = [0] * 6
+	for i in range(len(seqs) - 1):
+		for j in range(i + 1, len(seqs)):
+			transition_rate, transversion_rate, pair_sop, *pair_subs = \
+				msa_functions.compute_pairwise_substitution_rates(seqs[i], seqs[j])
+			transition_rates.append(transition_rate)
+			transversion_rates.append(transversion_rate)
+			sop_score += pair_sop
+			subs_cnts = [cnt + pair_cnt for cnt, pair_cnt in zip(subs_cnts, pair_subs)]
+	subs_sum = sum(subs_cnts)
+	return {"transition_avg": get_avg(transition_rates), "transversion_avg": get_avg(transversion_rates),
+	        "sop_score": sop_score}, \
+	       {pair.lower() + "_subs": cnt/subs_sum if subs_sum != 0 else 0
+	        for pair, cnt in zip(msa_functions.SUBS_PAIRS, subs_cnts)}
+
+
+@pytest.mark.parametrize("msa", get_alignments())
+def test_packed_substitution_counts(msa):
+	packed_msa = msa_functions.pack_msa(msa)
+	nchars = msa.get_alignment_length()
+	for i in range(len(msa) - 1):
+		substitution_count_dictionary, pa_length = msa_functions.infer_packed_substitution_counts(packed_msa, nchars, i)
+		for j in range(i + 1, len(msa)):
+			expected_dictionary, expected_pa_length = \
+				msa_functions.infer_pairwise_substitution_matrix(str(msa[i].seq), str(msa[j].seq))
+			assert pa_length[j - i - 1] == expected_pa_length
+			assert {k: substitution_count_dictionary[k][j - i - 1] for k in expected_dictionary} == expected_dictionary
+
+
+@pytest.mark.parametrize("msa", get_alignments())
+def test_substitution_rates(msa):
+	# exact reproduction of the pairwise computation, including the order of the summation of the rates
+	assert msa_functions.calculate_substitution_rates(msa) == calculate_pairwise_substitution_rates(msa)
+
+
+def test_substitution_rates_packing_blocks(monkeypatch):
+	msa = get_random_msa(4, ntaxa=20, nchars=130)
+	expected = msa_functions.calculate_substitution_rates(msa)
+	monkeypatch.setattr(msa_functions, "PACK_BLOCK_ROWS", 3)
+	assert msa_functions.calculate_substitution_rates(msa) == expected
@@ -0,0 +1,56 @@
+import os
+import sys
+
+import pytest
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PACKAGE_DIR)
+
+from definitions import *
+import msa_functions
+import partitions
+
+
+EXAMPLE_MSA = os.path.join(PACKAGE_DIR, "example", "test_msa.phy")
+
+
+def write_partitions_file(tmp_path, content):
+	partitions_filepath = str(tmp_path / "partitions.txt")
+	with open(partitions_filepath, "w") as fpw:
+		fpw.write(content)
+	return partitions_filepath
+
+
+def test_partition_msa():
+	msa = AlignIO.read(EXAMPLE_MSA, "phylip-relaxed")
+	slices = partitions.parse_ranges("1-10, 21-30\\2, 600-.")
+	partition_msa = partitions.get_partition_msa([rec.id for rec in msa], msa_functions.get_msa_chars(msa),
+	                                             partitions.get_partition_columns(slices, msa.get_alignment_length()))
+	expected_msa = msa[:, slices[0]] + msa[:, slices[1]] + msa[:, slices[2]]
+	assert [rec.id for rec in partition_msa] == [rec.id for rec in expected_msa]
+	assert [str(rec.seq) for rec in partition_msa] == [str(rec.seq) for rec in expected_msa]
+
+
+@pytest.mark.parametrize("ranges_string", ["500-100", "0-10", "701-800"])
+def test_invalid_partition_columns(ranges_string):
+	with pytest.raises(ValueError):
+		partitions.get_partition_columns(partitions.parse_ranges(ranges_string), 700)
+
+
+def test_partition_names(tmp_path):
+	partitions_lst = partitions.parse_partitions_file(write_partitions_file(
+		tmp_path, "begin sets;\ncharset 'gene 1;rm -rf' = 1-10;\ncharset gene2 = 11-.;\nend;\n"))
+	assert [name for name, _ in partitions_lst] == ["gene 1;rm -rf", "gene2"]
+	assert partitions.get_partition_msa_filepath("aln.phy", 1, partitions_lst[0][0]) == \
+	       "aln.phy_partition_1_gene_1_rm_-rf.phy"
+
+	models_filepath = str(tmp_path / "models.txt")
+	partitions.write_partition_models_file(partitions_lst, ["GTR+I+G", "HKY"], 20, models_filepath)
+	with open(models_filepath) as fpr:
+		assert fpr.read() == "GTR+I+G, gene_1_rm_-rf = 1-10\nHKY, gene2 = 11-20\n"
+
+
+def test_indistinct_partition_names(tmp_path):
+	with pytest.raises(ValueError):
+		partitions.parse_partitions_file(write_partitions_file(
+			tmp_path, "begin sets;\ncharset 'gene 1' = 1-10;\ncharset gene_1 = 11-.;\nend;\n"))
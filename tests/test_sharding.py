@@ -0,0 +1,72 @@
+import logging
+import os
+import sys
+import threading
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PACKAGE_DIR)
+
+from definitions import *
+import sharding
+
+
+def create_work_dir(tmp_path, nalignments):
+	work_dir = str(tmp_path)
+	for i in range(nalignments):
+		with open(os.path.join(work_dir, "msa{}.phy".format(i)), "w") as fpw:
+			fpw.write("")
+	with open(os.path.join(work_dir, "msa0.phy_phyml_stats_GTR.txt"), "w") as fpw:  # an output of a previous run
+		fpw.write("")
+	os.makedirs(os.path.join(work_dir, sharding.LEASES_DIRNAME))
+	return work_dir
+
+
+def test_claim_next_alignment(tmp_path, monkeypatch):
+	work_dir = create_work_dir(tmp_path, 20)
+	msa_filepaths = sharding.list_alignments(work_dir)
+	for msa_filepath in msa_filepaths[:5]:
+		sharding.create_marker_file(sharding.get_lease_filepaths(msa_filepath)[1], "other_worker")
+	for msa_filepath in msa_filepaths[5:]:
+		sharding.create_marker_file(sharding.get_lease_filepaths(msa_filepath)[0], "other_worker")
+	os.remove(sharding.get_lease_filepaths(msa_filepaths[7])[0])
+
+	# the alignments and their markers are listed, only the markers of the leased alignment are checked again
+	checked_filepaths = []
+	monkeypatch.setattr(os.path, "exists", lambda filepath: checked_filepaths.append(filepath))
+	monkeypatch.setattr(os.path, "isfile", lambda filepath: checked_filepaths.append(filepath))
+	finished = set()
+	assert sharding.claim_next_alignment(work_dir, "worker", 60, finished) == \
+	       (msa_filepaths[7], sharding.get_lease_filepaths(msa_filepaths[7])[0])
+	assert finished == set(msa_filepaths[:5])
+	assert checked_filepaths == list(sharding.get_lease_filepaths(msa_filepaths[7])[1:])
+	assert sharding.claim_next_alignment(work_dir, "worker", 60, finished) == (None, None)
+
+
+def test_claim_offsets(tmp_path):
+	work_dir = create_work_dir(tmp_path, 50)
+	claimed = [sharding.claim_next_alignment(work_dir, "worker" + str(i), 60)[0] for i in range(5)]
+	assert len(set(claimed)) == 5
+	assert claimed != sharding.list_alignments(work_dir)[:5]
+
+
+def test_run_workers(tmp_path, monkeypatch):
+	work_dir = create_work_dir(tmp_path, 30)
+	monkeypatch.setattr(sharding, "get_worker_id", lambda: threading.current_thread().name)
+	processed = []
+
+	def process_alignment(msa_filepath):
+		processed.append(msa_filepath)
+		if msa_filepath.endswith("msa3.phy"):
+			raise ValueError(msa_filepath)
+
+	workers = [threading.Thread(target=sharding.run_worker, name="worker" + str(i),
+	                            args=(work_dir, process_alignment, logging.getLogger(__name__)))
+	           for i in range(4)]
+	for worker in workers:
+		worker.start()
+	for worker in workers:
+		worker.join()
+	assert sorted(processed) == sharding.list_alignments(work_dir)
+	leased, finished = sharding.list_leases(work_dir)
+	assert not leased and finished == {os.path.basename(msa_filepath) for msa_filepath in processed}
+	assert os.path.exists(sharding.get_lease_filepaths(os.path.join(work_dir, "msa3.phy"))[2])
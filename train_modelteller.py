@@ -0,0 +1,217 @@
+import pickle
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from scipy import stats
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.model_selection import GroupKFold
+
+from definitions import *
+from utils import *
+import compute_features
+import modelteller
+import sharding
+
+
+N_ESTIMATORS = 500
+N_FOLDS = 5
+RANDOM_STATE = 1
+LOGGER_NAME = 'ModelTeller training'
+
+
+def init_logger():
+	"""
+	sets the logger of the script, which modelteller.process_alignments logs to as well. also the initializer of the
+	feature extraction processes, that do not run the __main__ block when they are spawned (e.g., on macOS and Windows)
+	"""
+	global logger
+	logger = logging.getLogger(LOGGER_NAME)
+	if not logger.handlers:  # forked processes inherit the configured logger
+		init_commandline_logger(logger)
+	modelteller.logger = logger
+
+
+def get_features_store_format():
+	"""
+	:return: "parquet" if a parquet engine (pyarrow or fastparquet) is installed, "csv" otherwise
+	"""
+	for engine in ["pyarrow", "fastparquet"]:
+		try:
+			__import__(engine)
+			return "parquet"
+		except ImportError:
+			continue
+	return "csv"
+
+
+def write_features_store(features_df, store_prefix):
+	"""
+	:return: the filepath of the store, store_prefix with the extension of its format
+	"""
+	store_format = get_features_store_format()
+	store_filepath = store_prefix + "." + store_format
+	temp_filepath = store_filepath + get_temp_suffix()
+	if store_format == "parquet":
+		features_df.to_parquet(temp_filepath, index=False)
+	else:
+		features_df.to_csv(temp_filepath, index=False)
+	os.replace(temp_filepath, store_filepath)
+	return store_filepath
+
+
+def read_features_store(store_filepath):
+	if store_filepath.endswith(".parquet"):
+		return pd.read_parquet(store_filepath)
+	return pd.read_csv(store_filepath)
+
+
+def extract_alignment_features(msa_filepath, corpus_dir, GTRIG_topology, fast):
+	"""
+	:param msa_filepath: a file of one or more MSAs, see modelteller.process_alignments
+	:return: a list of the features of every MSA of the file, with its id in "msa": the path of the MSA for PhyML,
+	relative to corpus_dir (e.g., "aln.phy", or "aln.fas.gz_record2.phy" for the second MSA of a compressed file)
+	"""
+	samples = []
+
+	def extract_features(msa_obj, record_filepath):
+		features, _ = compute_features.extract_features(msa_obj, record_filepath, GTRIG_topology, None, fast=fast)
+		features["msa"] = os.path.relpath(record_filepath, corpus_dir)
+		samples.append(features)
+
+	modelteller.process_alignments(msa_filepath, None, extract_features)
+	return samples
+
+
+def extract_corpus_features(corpus_dir, GTRIG_topology=False, fast=False, cpus=None):
+	"""
+	computes the features of all the alignments in corpus_dir, an alignment file per process
+	:return: a dataframe with the features of an MSA per row, and its id in "msa" (see extract_alignment_features)
+	"""
+	msa_filepaths = sharding.list_alignments(corpus_dir)
+	if not msa_filepaths:
+		raise ValueError("No alignment files were found in " + corpus_dir)
+	logger.info("Computing the features of " + str(len(msa_filepaths)) + " alignment files on " +
+	            str(cpus or os.cpu_count()) + " processes...")
+	samples = []
+	with ProcessPoolExecutor(max_workers=cpus, initializer=init_logger) as executor:
+		futures = {executor.submit(extract_alignment_features, msa_filepath, corpus_dir, GTRIG_topology, fast):
+			           msa_filepath for msa_filepath in msa_filepaths}
+		for i, future in enumerate(as_completed(futures), start=1):
+			try:
+				samples.extend(future.result())
+			except Exception:
+				logger.error("Failed to compute the features of " + futures[future] + ":\n" + traceback.format_exc())
+			if i % 100 == 0:
+				logger.info("Processed " + str(i) + "/" + str(len(msa_filepaths)) + " alignment files")
+
+	if not samples:
+		raise ValueError("The features of none of the alignments of " + corpus_dir + " were computed, see the errors "
+		                 "above")
+	features_df = pd.DataFrame(samples)
+	return features_df[["msa"] + [col for col in features_df.columns if col != "msa"]].sort_values("msa")
+
+
+def prepare_training_df(features_df, targets_df, target_column):
+	"""
+	:param features_df: see extract_corpus_features
+	:param targets_df: a dataframe with the "msa" id, the "model" (one of ALL_PHYML_MODELS) and the target value
+	:return: the features of every MSA and model with a target, as in compute_features.prepare_features_df
+	"""
+	ext_df = compute_features.expand_samples_to_models(features_df)
+	train_df = ext_df.merge(targets_df[["msa", "model", target_column]], on=["msa", "model"], how="inner")
+	missing = len(targets_df) - len(train_df)
+	if missing:
+		logger.warning(str(missing) + " target values have no features (unknown msa or model), they are ignored")
+	return train_df
+
+
+def summarize_predictions(train_df, target_column, pred_column):
+	"""
+	:return: a dataframe with a row per MSA: the models with the lowest target and prediction, the Spearman
+	correlation of the predicted and target ranks of the models, and the target difference of the predicted best
+	model from the best one
+	"""
+	rows = []
+	for msa, msa_df in train_df.groupby("msa", sort=True):
+		best_model = msa_df.loc[msa_df[target_column].idxmin(), "model"]
+		predicted_model = msa_df.loc[msa_df[pred_column].idxmin(), "model"]
+		rows.append({"msa": msa, "best_model": best_model, "predicted_model": predicted_model,
+		             "spearman": stats.spearmanr(msa_df[target_column], msa_df[pred_column])[0],
+		             "target_regret": msa_df.loc[msa_df["model"] == predicted_model, target_column].iloc[0] -
+		                              msa_df[target_column].min()})
+	return pd.DataFrame(rows)
+
+
+def train_forest(train_df, target_column, n_estimators=N_ESTIMATORS, n_folds=N_FOLDS, cpus=None):
+	"""
+	cross-validates a random forest regressor with the MSAs split between the folds (all the models of an MSA are
+	in the same fold), then fits it on all the data. the trees are fitted on cpus cpus (default: all)
+	:return: the fitted regressor and the validation summary of every MSA (see summarize_predictions)
+	"""
+	X, y = train_df[FEATURES_TO_INCLUDE], train_df[target_column]
+	train_df = train_df.copy()
+	train_df["pred_cv"] = np.nan
+	for fold_i, (train_index, test_index) in enumerate(GroupKFold(n_splits=n_folds).split(X, y, train_df["msa"])):
+		clf = RandomForestRegressor(n_estimators=n_estimators, n_jobs=cpus or -1, random_state=RANDOM_STATE)
+		clf.fit(X.iloc[train_index], y.iloc[train_index])
+		train_df.iloc[test_index, train_df.columns.get_loc("pred_cv")] = clf.predict(X.iloc[test_index])
+		logger.info("Fold {}/{}: R^2 = {:.3f}".format(fold_i + 1, n_folds,
+		                                              clf.score(X.iloc[test_index], y.iloc[test_index])))
+	validation_df = summarize_predictions(train_df, target_column, "pred_cv")
+
+	clf = RandomForestRegressor(n_estimators=n_estimators, n_jobs=cpus or -1, random_state=RANDOM_STATE)
+	clf.fit(X, y)
+	return clf, validation_df
+
+
+if __name__ == '__main__':
+	init_logger()
+
+	parser = argparse.ArgumentParser(description='Compute ModelTeller features for a corpus of alignments, and train '
+	                                             'a ModelTeller random forest')
+	subparsers = parser.add_subparsers(dest="command", required=True)
+	extract_parser = subparsers.add_parser("extract", help="Compute the features of all the alignments in a directory.")
+	extract_parser.add_argument('--corpus_dir', '-c', required=True,
+								help='A directory of alignment files (see the -m parameter of modelteller.py).')
+	extract_parser.add_argument('--features_store', '-o', required=True,
+								help='The features store path, without an extension. Written as parquet if pyarrow '
+									 'or fastparquet is installed, otherwise as csv.')
+	extract_parser.add_argument('--GTRIG_topology', '-g', action='store_true',
+								help="Compute the features as modelteller.py -g, for training a ModelTellerG forest.")
+	extract_parser.add_argument('--fast', '-f', action='store_true',
+								help="Compute the features as modelteller.py -f.")
+	extract_parser.add_argument('--cpus', type=int, default=None, help="The number of processes. Default: all cpus.")
+
+	train_parser = subparsers.add_parser("train", help="Train a random forest on a features store and target values.")
+	train_parser.add_argument('--features_store', '-i', required=True, help='A features store written by extract.')
+	train_parser.add_argument('--targets', '-t', required=True,
+							  help='A csv file with the columns "msa" (as in the features store), "model" (e.g., '
+								   'HKY+I+G) and the target value, lower is better (e.g., the branch-lengths error of '
+								   'the model).')
+	train_parser.add_argument('--target_column', default="target", help='The target column of --targets.')
+	train_parser.add_argument('--out_model', '-o', required=True,
+							  help='The output pickle, in the format of rf_models/ModelTeller_model.pkl.')
+	train_parser.add_argument('--n_estimators', type=int, default=N_ESTIMATORS, help='The number of trees.')
+	train_parser.add_argument('--n_folds', type=int, default=N_FOLDS, help='The number of cross-validation folds.')
+	train_parser.add_argument('--cpus', type=int, default=None, help="The number of cpus. Default: all cpus.")
+	args = parser.parse_args()
+
+	if args.command == "extract":
+		features_df = extract_corpus_features(args.corpus_dir, args.GTRIG_topology, args.fast, args.cpus)
+		store_filepath = write_features_store(features_df, args.features_store)
+		logger.info("The features of " + str(len(features_df)) + " MSAs are in: " + store_filepath)
+	else:
+		train_df = prepare_training_df(read_features_store(args.features_store), pd.read_csv(args.targets),
+		                               args.target_column)
+		logger.info("Training on " + str(len(train_df)) + " MSA-model pairs of " + str(train_df["msa"].nunique()) +
+		            " MSAs...")
+		clf, validation_df = train_forest(train_df, args.target_column, args.n_estimators, args.n_folds, args.cpus)
+		with open(args.out_model, "wb") as fpw:
+			pickle.dump(clf, fpw)
+		validation_filepath = args.out_model + "_validation.csv"
+		validation_df.to_csv(validation_filepath, index=False)
+		logger.info("Cross-validation: best model ranked first in {:.1%} of the MSAs, mean Spearman correlation "
+		            "{:.3f}, mean target regret {:.4g}. Per MSA: {}".format(
+			(validation_df["best_model"] == validation_df["predicted_model"]).mean(),
+			validation_df["spearman"].mean(), validation_df["target_regret"].mean(), validation_filepath))
+		logger.info("The model is in: " + args.out_model)
@@ -1,5 +1,6 @@
 from definitions import *
 from utils import compute_entropy, lists_diff
+import kernels
 
 
 def get_newick_tree(tree):
@@ -21,6 +22,61 @@ def reroot_tree(tree, outgroup_name):
 	return tree
 
 
+def reinsert_duplicate_tips(tree, duplicates):
+	"""
+	adds the removed copies of identical sequences as sister tips of the kept sequence, with the shortest branch
+	length phyml estimates. multiple copies form a caterpillar so the tree remains binary
+	:param tree: Tree node or tree file or newick tree string of the msa of distinct sequences
+	:param duplicates: see msa_functions.collapse_duplicate_sequences
+	:return: the tree with all the tips of the full msa
+	"""
+	tree = get_newick_tree(tree)
+	leaves_by_name = {leaf.name: leaf for leaf in tree.iter_leaves()}
+	for rep_name in duplicates:
+		subtree = leaves_by_name[rep_name]
+		for dup_name in duplicates[rep_name]:
+			parent = subtree.up
+			subtree.detach()
+			new_node = parent.add_child(dist=subtree.dist)
+			new_node.add_child(subtree, dist=PHYML_MIN_BRANCH_LENGTH)
+			new_node.add_child(name=dup_name, dist=PHYML_MIN_BRANCH_LENGTH)
+			subtree = new_node
+	return tree
+
+
+def write_tree_with_duplicates(tree_filepath, duplicates):
+	"""
+	:return: the path of a copy of tree_filepath with the removed identical sequences reinserted
+	"""
+	tree_with_duplicates_filepath = os.path.splitext(tree_filepath)[0] + "_with_duplicates.txt"
+	reinsert_duplicate_tips(tree_filepath, duplicates).write(format=1, outfile=tree_with_duplicates_filepath)
+	return tree_with_duplicates_filepath
+
+
+def prune_duplicate_tips(tree, duplicates):
+	"""
+	:param tree: Tree node or tree file or newick tree string of the full msa
+	:param duplicates: see msa_functions.collapse_duplicate_sequences
+	:return: the tree restricted to the kept sequences
+	"""
+	tree = get_newick_tree(tree)
+	tree.prune(list(duplicates), preserve_branch_length=True)
+	return tree
+
+
+def reroot_at_largest_branch(tree):
+	"""
+	:param tree: Tree node or tree file or newick tree string;
+	:return: the tree rooted at its largest branch, if possible
+	"""
+	tree = get_newick_tree(tree)
+	try:
+		tree.set_outgroup(get_largest_branch(tree))
+	except ete3.coretype.tree.TreeError:
+		pass
+	return tree
+
+
 def get_frac_of_cherries(tree):
 	"""
 	McKenzie, Andy, and Mike Steel. "Distributions of cherries for two models of trees."
@@ -59,23 +115,19 @@ def get_stemminess_indexes(tree):
 		formula cumulative stemminess: https://onlinelibrary.wiley.com/doi/pdf/10.1111/j.1558-5646.1985.tb00398.x
 		formula noncumulative stemminess: https://onlinelibrary.wiley.com/doi/epdf/10.1111/j.1558-5646.1990.tb03855.x
 		"""
-	subtree_blsum_dict = {}
-	nodes_height_dict = {}
-	stem85_index_lst = []
-	stem90_index_lst = []
-	for node in tree.traverse(strategy="postorder"):
-		if node.is_leaf():
-			subtree_blsum_dict[node] = 0
-			nodes_height_dict[node] = 0
-		elif node.is_root():
-			continue
-		else:
-			subtree_blsum_dict[node] = subtree_blsum_dict[node.children[0]] + subtree_blsum_dict[node.children[1]] + \
-			                           node.children[0].dist + node.children[1].dist
-			nodes_height_dict[node] = max(nodes_height_dict[node.children[0]] + node.children[0].dist,
-			                              nodes_height_dict[node.children[1]] + node.children[1].dist)
-			stem85_index_lst.append(node.dist/(subtree_blsum_dict[node] + node.dist))
-			stem90_index_lst.append(node.dist/(nodes_height_dict[node]) + node.dist)
+	nodes = list(tree.traverse(strategy="postorder"))
+	nodes_indexes = {node: i for i, node in enumerate(nodes)}
+	children = np.full((len(nodes), 2), -1, dtype=np.int64)
+	for i, node in enumerate(nodes):
+		if not node.is_leaf():
+			children[i] = [nodes_indexes[node.children[0]], nodes_indexes[node.children[1]]]
+	dists = np.array([node.dist for node in nodes], dtype=float)
+	subtree_blsum, nodes_height = kernels.accumulate_postorder(children, dists)
+
+	internal = children[:, 0] >= 0
+	internal[-1] = False  # the root is last
+	stem85_index_lst = dists[internal]/(subtree_blsum[internal] + dists[internal])
+	stem90_index_lst = dists[internal]/(nodes_height[internal]) + dists[internal]
 
 	return np.mean(stem85_index_lst), np.mean(stem90_index_lst)
 
@@ -44,6 +44,47 @@ def is_file_empty(filepath):
 	return True
 
 
+def get_temp_suffix():
+	"""
+	:return: a suffix that is unique to the running host, process and thread, so temporary files of concurrent
+	workers that share a filesystem never collide
+	"""
+	return ".tmp_" + socket.gethostname() + "_" + str(os.getpid()) + "_" + str(threading.get_ident())
+
+
+def write_csv_atomically(df, csv_filepath, index=True):
+	"""
+	writes the dataframe to a temporary file and renames it, so readers never see a partially written table
+	"""
+	temp_filepath = csv_filepath + get_temp_suffix()
+	df.to_csv(temp_filepath, index=index)
+	os.replace(temp_filepath, csv_filepath)
+
+
+# the magic bytes of the compressed files that are decompressed on the fly, and the function that opens them
+COMPRESSION_OPENERS = [(b"\x1f\x8b", gzip.open), (b"\xfd7zXZ\x00", lzma.open), (b"BZh", bz2.open)]
+
+
+def get_decompression_opener(filepath):
+	"""
+	:return: the function that opens filepath if it is compressed (by its content, not its extension), otherwise None
+	"""
+	with open(filepath, "rb") as fpr:
+		magic_bytes = fpr.read(6)
+	for magic, opener in COMPRESSION_OPENERS:
+		if magic_bytes.startswith(magic):
+			return opener
+	return None
+
+
+def open_alignment_file(filepath):
+	"""
+	:return: a text file object of filepath, compressed files are decompressed while read, without an uncompressed copy
+	"""
+	opener = get_decompression_opener(filepath)
+	return open(filepath) if opener is None else opener(filepath, "rt")
+
+
 def compute_entropy(lst, epsilon=0.000001):
 	if np.sum(lst) != 0:
 		lst_norm = np.array(lst)/np.sum(lst)